@@ -0,0 +1,220 @@
+#!/usr/bin/env python2
+
+# Generate a synthetic Open Directory / Samba4 realm for the od2samba4 benchmarks.
+#
+# Usage:
+# generate_realm.py [--users N] [--seed SEED] WORKDIR
+#
+# WORKDIR will contain everything the od2samba4 scripts need to run against the in-memory
+# LDAP stand-in (bench/standin) instead of real servers:
+# - directory.json: OD users and groups (with memberUid and nested groups) and the matching
+#   Samba4 users and groups (with objectSid), loaded by the LDAP stand-in
+# - in/kdc_dump.mit: MIT Kerberos dump (kdb5_util dump -b7 format) with a principal for every user,
+#   the "encrypted" keys are the plain hashes
+# - in/hpropd_print.txt: Hashes of all principals in `hpropd -n --print` format
+# - heimdal/hprop, heimdal/hpropd: Fake heimdal executables, hprop outputs the line of in/hpropd_print.txt of
+#   every principal it receives (so that only principals passed by the pre-pass of extract_hashes.py are decrypted)
+# - out/user_hashes.db: Hashes file as written by extract_hashes.py
+# - od2samba4.conf, groups.json: Configuration pointing to the files above
+#
+# Groups are generated with about 50 members per group on average, every user is a member of
+# one to five groups and about a fifth of all groups is nested into another group.
+
+from __future__ import print_function
+from optparse import OptionParser
+import base64
+import random
+import struct
+import json
+import stat
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from od2s4.hashstore import HashStoreWriter
+from od2s4.records import HashRecord
+
+parser = OptionParser(usage = "%prog [options] WORKDIR")
+parser.add_option("-u", "--users", type = "int", default = 1000, help = "Number of users (default: 1000)")
+parser.add_option("-s", "--seed", type = "int", default = 2016, help = "Random seed (default: 2016)")
+(cmdline_opts, args) = parser.parse_args()
+if len(args) != 1:
+	parser.error("WORKDIR is required")
+
+workdir = args[0]
+rnd = random.Random(cmdline_opts.seed)
+
+OD_DC = "dc=od,dc=example,dc=org"
+SAMBA4_DC = "dc=example,dc=org"
+REALM = "OD.EXAMPLE.ORG"
+DOMAIN_SID = "\x01\x04\x00\x00\x00\x00\x00\x05\x15\x00\x00\x00" + "\x2a" * 12
+
+def randomHex(length):
+	return "%0*x" % (length, rnd.getrandbits(length * 4))
+
+def guid(kind, number):
+	return "%08X-0000-4000-8000-%012X" % (kind, number)
+
+def objectSid(rid):
+	return base64.b64encode(DOMAIN_SID + struct.pack("<I", rid))
+
+for directory in ["in", "out", "heimdal"]:
+	if not os.path.isdir(os.path.join(workdir, directory)):
+		os.makedirs(os.path.join(workdir, directory))
+
+nusers = cmdline_opts.users
+ngroups = max(2, nusers // 50)
+uids = ["user%06d" % i for i in range(nusers)]
+
+entries = []
+
+# Groups: group 0 is "staff" (primary group of all users, merged into "Domain Users"),
+# all other groups are migrated. Every user is a member of 1 to 5 groups.
+members = [[] for i in range(ngroups)]
+for uid in uids:
+	members[0].append(uid)
+	for group in rnd.sample(range(1, ngroups), min(ngroups - 1, rnd.randint(0, 4))):
+		members[group].append(uid)
+
+groupnames = ["staff"] + ["group%05d" % i for i in range(1, ngroups)]
+groupactions = {"staff" : {"target" : "Domain Users", "type" : "merge"}}
+for i in range(ngroups):
+	group = {
+		"objectClass" : ["posixGroup", "apple-group", "extensibleObject"],
+		"cn" : [groupnames[i]],
+		"gidNumber" : [str(20 if i == 0 else 10000 + i)],
+		"apple-generateduid" : [guid(0x6000, i)],
+		"apple-group-realname" : ["Synthetic Group %d" % i],
+		"memberUid" : members[i]
+	}
+	# Nest about a fifth of all groups into a group with a lower number (no cycles)
+	if i > 1 and rnd.random() < 0.2:
+		parent = rnd.randint(1, i - 1)
+		nested = entries[parent][1].setdefault("apple-group-nestedgroup", [])
+		nested.append(group["apple-generateduid"][0])
+	entries.append(("cn=" + groupnames[i] + ",cn=groups," + OD_DC, group))
+	if i > 0:
+		groupactions[groupnames[i]] = {"target" : groupnames[i], "type" : "migrate"}
+
+# Samba4 groups: Domain Users (RID 513) and all migrated groups
+entries.append(("CN=Domain Users,CN=Users," + SAMBA4_DC, {"objectClass" : ["top", "group"], "cn" : ["Domain Users"],
+		"objectSid" : [objectSid(513)], "gidNumber" : ["20"]}))
+for i in range(1, ngroups):
+	entries.append(("CN=" + groupnames[i] + ",CN=Users," + SAMBA4_DC, {"objectClass" : ["top", "group"], "cn" : [groupnames[i]],
+			"objectSid" : [objectSid(1100 + i)], "gidNumber" : [str(10000 + i)]}))
+
+# Users in OD and Samba4, hashes in MIT dump and hpropd --print format
+kdc_dump = open(os.path.join(workdir, "in", "kdc_dump.mit"), "w")
+kdc_dump.write("kdb5_util load_dump version 7\n")
+hpropd_print = open(os.path.join(workdir, "in", "hpropd_print.txt"), "w")
+hashes = HashStoreWriter(os.path.join(workdir, "out", "user_hashes.db"))
+for i, uid in enumerate(uids):
+	user = {
+		"objectClass" : ["top", "person", "organizationalPerson", "inetOrgPerson", "posixAccount", "shadowAccount", "apple-user", "extensibleObject"],
+		"uid" : [uid],
+		"cn" : ["Synthetic User %d" % i],
+		"givenName" : ["Synthetic"],
+		"sn" : ["User %d" % i],
+		"homeDirectory" : ["/home/" + uid],
+		"loginShell" : ["/bin/bash"],
+		"gidNumber" : ["20"],
+		"uidNumber" : [str(10000 + i)],
+		"apple-generateduid" : [guid(0x1000, i)],
+		"apple-user-homeurl" : ["<home_dir><url>afp://fileserver/home</url><path>" + uid + "</path></home_dir>"],
+		"modifyTimestamp" : ["2016%02d%02d120000Z" % (1 + i % 12, 1 + i % 28)]
+	}
+	if i % 3 == 0:
+		user["mail"] = [uid + "@example.org"]
+	else:
+		user["apple-user-mailattribute"] = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?><dict><key>kAutoForwardValue</key><string>"
+				+ uid + "@forward.example.org</string><key>kMailAccountState</key><string>Enabled</string></dict>"]
+	entries.append(("uid=" + uid + ",cn=users," + OD_DC, user))
+	entries.append(("CN=" + uid + ",CN=Users," + SAMBA4_DC, {"objectClass" : ["top", "person", "organizationalPerson", "user"],
+			"cn" : [uid], "uid" : [uid]}))
+
+	userhashes = {"type18" : randomHex(64), "type17" : randomHex(32), "type23" : randomHex(32)}
+	if i % 4 != 0:
+		userhashes["type3"] = randomHex(16)
+		userhashes["type1"] = randomHex(16)
+	flags = 128 if i % 50 == 0 else 0
+	enctypes = [e for e in ["type18", "type17", "type23", "type3", "type1"] if e in userhashes]
+	keys = "1:" + ":".join(e[4:] + ":" + userhashes[e] + ":-" for e in enctypes)
+	principal = uid + "@" + REALM
+	key_data = ["1\t1\t" + e[4:] + "\t" + str(len(userhashes[e]) // 2) + "\t" + userhashes[e] for e in enctypes]
+	kdc_dump.write("\t".join(["princ", "38", str(len(principal)), "1", str(len(enctypes)), "0", principal, str(flags), "36000", "604800",
+			"0", "0", "0", "0", "0", "1", "5", "00e1846b56"] + key_data + ["-1;"]) + "\n")
+	print(uid + "@" + REALM + " " + keys + " 20160101000000:admin@" + REALM + " 20160101000000:admin@" + REALM
+			+ " - - - 36000 604800 " + str(flags) + " - -", file = hpropd_print)
+
+	hashes.add(HashRecord(username = uid, salt = REALM + uid, flags = flags, **userhashes))
+kdc_dump.close()
+hpropd_print.close()
+hashes.close()
+
+# objectGUID and uSNChanged of Samba4 users and groups, rootDSE with the highest committed USN
+samba_entries = [entry for dn, entry in entries if dn.endswith(",CN=Users," + SAMBA4_DC)]
+for usn, entry in enumerate(samba_entries, 1):
+	entry["objectGUID"] = [base64.b64encode(struct.pack("<IHH", 0x5000, 0, 0x4000) + struct.pack(">Q", usn))]
+	entry["uSNChanged"] = [str(usn)]
+entries.append(("", {"objectClass" : ["top"], "dsServiceName" : ["CN=NTDS Settings,CN=DC,CN=Servers,CN=Default-First-Site-Name,CN=Sites,CN=Configuration," + SAMBA4_DC],
+		"highestCommittedUSN" : [str(len(samba_entries))]}))
+
+open(os.path.join(workdir, "directory.json"), "w").write(json.dumps(entries))
+open(os.path.join(workdir, "groups.json"), "w").write(json.dumps(groupactions, indent = 4, sort_keys = True))
+open(os.path.join(workdir, "in", "kdc_master_key"), "w").close()
+
+# The dump state of a previous run would skip the extraction of the regenerated dump
+if os.path.exists(os.path.join(workdir, "out", "dump_state.json")):
+	os.remove(os.path.join(workdir, "out", "dump_state.json"))
+
+# Fake heimdal: hprop looks up the principals of the dump it reads from stdin in hpropd_print.txt, hpropd passes them through
+HPROP = """#!/bin/sh
+awk -F '\\t' 'NR == FNR { split($0, fields, " "); line[fields[1]] = $0; next } $1 == "princ" && ($7 in line) { print line[$7] }' \\
+	"$(dirname "$0")/../in/hpropd_print.txt" -
+"""
+for name, script in [("hprop", HPROP), ("hpropd", "#!/bin/sh\ncat\n")]:
+	path = os.path.join(workdir, "heimdal", name)
+	open(path, "w").write(script)
+	os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+config = open(os.path.join(workdir, "od2samba4.conf"), "w")
+config.write("""[files]
+mit_dump = in/kdc_dump.mit
+master_key = in/kdc_master_key
+heimdal_path = heimdal
+hashes = out/user_hashes.db
+dump_state = out/dump_state.json
+users_ldif = out/addusers.ldif
+newusers_ldif = out/newusers.ldif
+changedusers_ldif = out/changedusers.ldif
+users_state = out/users_state.json
+groups_ldif = out/addgroups.ldif
+membership_ldif = out/setmembership.ldif
+hashes_ldif = out/sethashes.ldif
+hashes_state = out/hashes_state.json
+samba_cache = out/samba_cache.sqlite
+
+[opendirectory]
+dc = """ + OD_DC + """
+url = ldap://od.bench.invalid
+username = diradmin
+password = bench
+host = od.bench.invalid
+sshuser = root
+sshpass = bench
+page_size = 500
+
+[samba4]
+dc = """ + SAMBA4_DC + """
+url = ldap://dc.bench.invalid
+username = Administrator
+password = bench
+page_size = 1000
+sam_ldb = sam.ldb
+commit_size = 500
+nis_domain = example
+upn_realm = example.org
+""")
+config.close()
+
+print("Generated realm with " + str(nusers) + " users and " + str(ngroups) + " groups in " + workdir)
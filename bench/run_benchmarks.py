@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+
+# Benchmark all od2samba4 pipeline stages against synthetic realms.
+#
+# Usage:
+# run_benchmarks.py [--sizes 1000,10000,100000] [--stages STAGES] [--workdir DIR] [--json FILE]
+#
+# For every realm size, a synthetic realm is generated using generate_realm.py and the stages
+# extract_hashes.py, convert_hashes.py, convert_users.py and convert_groups.py are run one after
+# another as child processes against the in-memory LDAP stand-in (bench/standin) and fake heimdal
+# executables. Wall time, CPU time and peak RSS of every stage are measured using wait4 and reported
+# together with the throughput (entries per second). Mind that the LDAP stand-in runs inside the
+# stage's process, so loading and searching the synthetic directory is included in the measurements.
+#
+# convert_hashes.py requires the samba python bindings and is reported as failed if they are missing.
+
+from __future__ import print_function
+from optparse import OptionParser
+import subprocess
+import json
+import time
+import sys
+import os
+
+BENCH_PATH = os.path.dirname(os.path.realpath(__file__))
+REPO_PATH = os.path.dirname(BENCH_PATH)
+
+# (stage name, command line arguments, entry count: "users" or "groups")
+STAGES = [
+	("extract_hashes", ["extract_hashes.py"], "users"),
+	("convert_hashes", ["convert_hashes.py", "--full"], "users"),
+	("convert_users", ["convert_users.py"], "users"),
+	("convert_groups", ["convert_groups.py", "-a"], "groups")
+]
+
+parser = OptionParser()
+parser.add_option("--sizes", default = "1000,10000,100000", help = "Comma-separated list of realm sizes (number of users)")
+parser.add_option("--stages", default = ",".join(s[0] for s in STAGES), help = "Comma-separated list of stages to run")
+parser.add_option("--workdir", default = os.path.join(BENCH_PATH, "work"), help = "Directory for generated realms and outputs")
+parser.add_option("--json", default = None, help = "Also write results to this file in JSON format")
+(cmdline_opts, args) = parser.parse_args()
+
+sizes = [int(s) for s in cmdline_opts.sizes.split(",")]
+stages = [s for s in STAGES if s[0] in cmdline_opts.stages.split(",")]
+
+# Run command in workdir, return (exit status, wall time, user CPU time, system CPU time, peak RSS in KiB)
+def run(command, workdir, env, logfile):
+	log = open(logfile, "w")
+	start = time.time()
+	proc = subprocess.Popen(command, cwd = workdir, env = env, stdout = log, stderr = subprocess.STDOUT)
+	pid, status, rusage = os.wait4(proc.pid, 0)
+	wall = time.time() - start
+	log.close()
+	proc.returncode = status
+	return (os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1, wall, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+
+results = []
+print("{:<16} {:>8} {:>6} {:>10} {:>10} {:>12} {:>12}".format("stage", "size", "status", "wall [s]", "cpu [s]", "entries/s", "peak RSS [MiB]"))
+for size in sizes:
+	workdir = os.path.join(cmdline_opts.workdir, str(size))
+	subprocess.check_call([sys.executable, os.path.join(BENCH_PATH, "generate_realm.py"), "--users", str(size), workdir], stdout = open(os.devnull, "w"))
+	counts = {"users" : size, "groups" : max(2, size // 50)}
+
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join([os.path.join(BENCH_PATH, "standin"), REPO_PATH] + ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+	env["OD2S4_BENCH_DIRECTORY"] = os.path.join(workdir, "directory.json")
+
+	for name, command, counttype in stages:
+		status, wall, utime, stime, maxrss = run([sys.executable, os.path.join(REPO_PATH, command[0])] + command[1:],
+				workdir, env, os.path.join(workdir, name + ".log"))
+		result = {"stage" : name, "size" : size, "status" : status, "wall" : wall, "utime" : utime, "stime" : stime,
+				"entries" : counts[counttype], "throughput" : counts[counttype] / wall, "maxrss_kib" : maxrss}
+		results.append(result)
+		print("{:<16} {:>8} {:>6} {:>10.2f} {:>10.2f} {:>12.0f} {:>12.1f}".format(name, size, "ok" if status == 0 else "FAIL",
+				wall, utime + stime, result["throughput"], maxrss / 1024.0))
+
+if cmdline_opts.json:
+	open(cmdline_opts.json, "w").write(json.dumps(results, indent = 4, sort_keys = True))
+
+if any(r["status"] != 0 for r in results):
+	print("Some stages failed, see <workdir>/<size>/<stage>.log for details.")
+	sys.exit(1)
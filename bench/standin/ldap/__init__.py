@@ -0,0 +1,182 @@
+# In-memory LDAP server stand-in for the od2samba4 benchmarks.
+# Implements the subset of python-ldap that the od2samba4 scripts use. All directory entries
+# (Open Directory and Samba4) are loaded from the JSON file given by the OD2S4_BENCH_DIRECTORY
+# environment variable, which is generated by bench/generate_realm.py. Binary attributes
+# (objectSid, objectGUID) are stored base64-encoded in that file.
+#
+# Only the filter syntax used by od2samba4 is supported: equality, presence, >= and <= comparisons
+# combined with & and |. Server controls other than the paged results control are ignored.
+
+import base64
+import json
+import os
+
+OPT_X_TLS_REQUIRE_CERT = 0x6006
+OPT_X_TLS_ALLOW = 3
+OPT_REFERRALS = 8
+OPT_NETWORK_TIMEOUT = 0x5005
+SCOPE_BASE = 0
+SCOPE_ONELEVEL = 1
+SCOPE_SUBTREE = 2
+MOD_ADD = 0
+MOD_DELETE = 1
+MOD_REPLACE = 2
+RES_BIND = 97
+RES_SEARCH_RESULT = 101
+RES_EXTENDED = 120
+
+BINARY_ATTRIBUTES = ["objectSid", "objectGUID"]
+
+class LDAPError(Exception):
+	pass
+
+class SERVER_DOWN(LDAPError):
+	pass
+
+class CONNECT_ERROR(LDAPError):
+	pass
+
+class TIMEOUT(LDAPError):
+	pass
+
+class UNAVAILABLE(LDAPError):
+	pass
+
+class BUSY(LDAPError):
+	pass
+
+_directory = None
+
+def _load():
+	global _directory
+	if _directory is None:
+		_directory = []
+		for dn, attributes in json.loads(open(os.environ["OD2S4_BENCH_DIRECTORY"], "r").read()):
+			entry = {}
+			for key, values in attributes.items():
+				if key in BINARY_ATTRIBUTES:
+					values = [base64.b64decode(v) for v in values]
+				else:
+					values = [v.encode("utf-8") if not isinstance(v, str) else v for v in values]
+				entry[key] = values
+			_directory.append((str(dn), entry))
+	return _directory
+
+# Parse filter string into nested tuples: ("&", [subfilters]), ("|", [subfilters]), (op, attribute, value)
+def _parseFilter(filterstr, pos = 0):
+	assert filterstr[pos] == "("
+	if filterstr[pos + 1] in "&|":
+		op = filterstr[pos + 1]
+		pos += 2
+		subfilters = []
+		while filterstr[pos] == "(":
+			subfilter, pos = _parseFilter(filterstr, pos)
+			subfilters.append(subfilter)
+		return ((op, subfilters), pos + 1)
+	end = filterstr.index(")", pos)
+	item = filterstr[pos + 1:end]
+	for op in [">=", "<=", "="]:
+		if op in item:
+			attribute, value = item.split(op, 1)
+			return ((op, attribute.lower(), value), end + 1)
+	raise LDAPError("Unsupported filter " + filterstr)
+
+def _match(filt, entry):
+	if filt[0] == "&":
+		return all(_match(f, entry) for f in filt[1])
+	if filt[0] == "|":
+		return any(_match(f, entry) for f in filt[1])
+	op, attribute, value = filt
+	values = [v for key, vals in entry.items() if key.lower() == attribute for v in vals]
+	if op == "=" and value == "*":
+		return len(values) > 0
+	if op == "=":
+		return any(v.lower() == value.lower() for v in values)
+	# Integer attributes (uSNChanged) are compared numerically, everything else (modifyTimestamp) as strings
+	if value.isdigit():
+		values = [int(v) for v in values if v.isdigit()]
+		value = int(value)
+	if op == ">=":
+		return any(v >= value for v in values)
+	return any(v <= value for v in values)
+
+class LDAPObject(object):
+	def __init__(self, url):
+		self.url = url
+		self.msgid = 0
+		self.pending = {}
+		self.paged = {}
+
+	def _next(self, result):
+		self.msgid += 1
+		self.pending[self.msgid] = result
+		return self.msgid
+
+	def set_option(self, option, value):
+		pass
+
+	def start_tls_s(self):
+		pass
+
+	def simple_bind(self, who = "", cred = ""):
+		return self._next((RES_BIND, []))
+
+	def simple_bind_s(self, who = "", cred = ""):
+		return self.result(self.simple_bind(who, cred))
+
+	def unbind_s(self):
+		pass
+
+	def _search(self, base, scope, filterstr, attrlist):
+		filt = _parseFilter(filterstr)[0]
+		base = base.lower()
+		wanted = set(a.lower() for a in attrlist) if attrlist else None
+		results = []
+		for dn, entry in _load():
+			ldn = dn.lower()
+			if scope == SCOPE_BASE and ldn != base:
+				continue
+			if scope != SCOPE_BASE and not ldn.endswith("," + base):
+				continue
+			if _match(filt, entry):
+				results.append((dn, dict((k, list(v)) for k, v in entry.items() if wanted is None or k.lower() in wanted)))
+		return results
+
+	# Paged searches are only evaluated by their first request, the results are kept in self.paged until the last
+	# page was returned. The cookie is the offset of the next page.
+	def search_ext(self, base, scope, filterstr = "(objectClass=*)", attrlist = None, attrsonly = 0, serverctrls = None, clientctrls = None, timeout = -1, sizelimit = 0):
+		from ldap.controls import SimplePagedResultsControl
+		paging = [c for c in serverctrls or [] if c.controlType == SimplePagedResultsControl.controlType]
+		if not paging:
+			return self._next((RES_SEARCH_RESULT, self._search(base, scope, filterstr, attrlist), []))
+
+		control = paging[0]
+		key = (base, scope, filterstr, tuple(attrlist or []))
+		if not control.cookie or not key in self.paged:
+			self.paged[key] = self._search(base, scope, filterstr, attrlist)
+		results = self.paged[key]
+		start = int(control.cookie or 0)
+		end = start + control.size
+		if end < len(results):
+			cookie = str(end)
+		else:
+			cookie = ""
+			del self.paged[key]
+		return self._next((RES_SEARCH_RESULT, results[start:end], [SimplePagedResultsControl(True, size = control.size, cookie = cookie)]))
+
+	def search_s(self, base, scope, filterstr = "(objectClass=*)", attrlist = None, attrsonly = 0):
+		return self._search(base, scope, filterstr, attrlist)
+
+	def result(self, msgid = -1, all = 1, timeout = None):
+		result = self.pending.pop(msgid)
+		return (result[0], result[1])
+
+	def result3(self, msgid = -1, all = 1, timeout = None):
+		result = self.pending.pop(msgid)
+		return (result[0], result[1], msgid, result[2] if len(result) > 2 else [])
+
+def initialize(url):
+	return LDAPObject(url)
+
+def set_option(option, value):
+	pass
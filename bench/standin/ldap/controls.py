@@ -0,0 +1,15 @@
+# Stand-in for ldap.controls, see bench/standin/ldap/__init__.py
+
+class LDAPControl(object):
+	def __init__(self, controlType = None, criticality = False, encodedControlValue = None):
+		self.controlType = controlType
+		self.criticality = criticality
+		self.encodedControlValue = encodedControlValue
+
+class SimplePagedResultsControl(object):
+	controlType = "1.2.840.113556.1.4.319"
+
+	def __init__(self, criticality = True, size = 10, cookie = ""):
+		self.criticality = criticality
+		self.size = size
+		self.cookie = cookie
@@ -1,41 +1,21 @@
 #!/usr/bin/env python2
 
 # Convert Open Directory groups to LDIF for Samba4 import.
-# Generates a script that establishes secondary group membership for all users.
+# Generates a second LDIF that establishes secondary group membership for all users.
 
 from __future__ import print_function
-from ConfigParser import RawConfigParser
 from optparse import OptionParser
+from od2s4.ldapsearch import get_page_size
+from od2s4.context import Context
+from od2s4.groupgraph import GroupGraph
+from od2s4.ldifwriter import LDIFWriter
+from od2s4.records import Group
+from od2s4 import metrics
+from convert_users import isMigrated
 import struct
 import ldap
-import ldif
-import stat
 import json
-import os
-
-# Parse command line options
-parser = OptionParser()
-parser.add_option("-a", "--amend-nis-props", action="store_true", default = False, help = "Amend NIS Domain, NIS Name and gidNumber attribute to existing AD system groups")
-(cmdline_opts, args) = parser.parse_args()
-
-# Parse configuration
-config = RawConfigParser()
-config.read("od2samba4.conf")
-
-od_password = config.get("opendirectory", "password")
-outfile_ldif_name = config.get("files", "groups_ldif")
-outfile_script_name = config.get("files", "membership_script")
-od_username = config.get("opendirectory", "username")
-od_url = config.get("opendirectory", "url")
-od_dc = config.get("opendirectory", "dc")
-samba4_dc = config.get("samba4", "dc")
-samba4_url = config.get("samba4", "url")
-samba4_username = config.get("samba4", "username")
-samba4_password = config.get("samba4", "password")
-nis_domain = config.get("samba4", "nis_domain")
-
-# Parse JSON that defines what to do with groups (migrate or merge)
-groupactions = json.loads(open("groups.json", "r").read())
+import sys
 
 # Group attributes that will be retrieved from OD DC (and then processed)
 GROUPATTRIBUTES = [
@@ -43,145 +23,226 @@ GROUPATTRIBUTES = [
 	"cn",				# Group name (short version)
 	"apple-group-realname",		# Group name (long, human-readable version), becomes description in samba4
 	"apple-generateduid",		# Becomes objectGUID in samba4
-	"memberUid",			# Will be used to generate secondary membership-establishing script and kept for samba4 import
+	"memberUid",			# Will be used to generate secondary membership-establishing LDIF
 	"apple-group-nestedgroup"	# Used to replicate nested group structure on Samba4 AD DC
 ]
 
-# Use certificates only for encryption, not authentication (self-signed)
-ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
-
-# Connect to Open Directory
-print("Connecting to Open Directory server")
-od = ldap.initialize(od_url)
-od.simple_bind_s("uid=" + od_username + ",cn=users," + od_dc, od_password)
-od_results = od.search_s("cn=groups," + od_dc, ldap.SCOPE_SUBTREE, "(objectclass=posixGroup)", GROUPATTRIBUTES)
-
-# If command line option -a / --amend-nis-props is used, amend existing samba groups with NIS Domain, NIS Name and a gidNumber matching
-# the group's RID + 1e8 (= last Block of objectSid = number used for primaryGroupID). Connect to Samba4 server to retrieve a list of existing groups.
-samba4_sysgroups = {}
-if cmdline_opts.amend_nis_props:
-	print("Connecting to Samba4 server")
-	samba = ldap.initialize(samba4_url)
-	samba.set_option(ldap.OPT_REFERRALS, 0)
-	samba.start_tls_s()
-	samba.simple_bind_s("cn=" + samba4_username + ",cn=Users," + samba4_dc, samba4_password)
-
-	samba_results = samba.search_s("cn=Users," + samba4_dc, ldap.SCOPE_SUBTREE, "(objectclass=group)", ["cn", "objectSid"])
-	groupslist = [g[1] for g in samba_results]
-	for sysgroup in groupslist:
-		samba4_sysgroups[sysgroup["cn"][0]] = struct.unpack("<i", sysgroup["objectSid"][0][-4:])[0]
-	print("Retrieved list of " + str(len(groupslist)) + " existing groups from Samba4")
-
-# Clean search results: Extract attributes from [(DN, attributes)] list od_results
-# Delete all groups that are not going to be migrated / merged from list
-od_groups = [g[1] for g in od_results]
-print("Retrieved group list with " + str(len(od_groups)) + " entries from Open Directory")
-od_groups = [g for g in od_groups if g["cn"][0] in groupactions]
-
-def write_replace(fd, key, value):
-	print("-", file = fd)
-	print("replace: " + key, file = fd)
-	print(key + ": " + value, file = fd)
-
-# Generate LDIF for import into Samba4 via ldbadd
-# Writing the LDIF manually (instead of using LDIFWriter) is simpler in this case.
-outfile_ldif = open(outfile_ldif_name, "wb")
-outfile_script = open(outfile_script_name, "w")
-print("#!/bin/bash", file = outfile_script)
-od_count = 0
-for group in od_groups:
-	if not group["cn"][0] in groupactions:
-		continue
-
-	print("Processing group " + group["cn"][0])
-
-	target = groupactions[group["cn"][0]]["target"]
-	actiontype = groupactions[group["cn"][0]]["type"]
-
-	print("dn: CN=" + target + ",CN=Users," + samba4_dc, file = outfile_ldif)
-	group["msSFU30Name"] = [target]
-	group["msSFU30NisDomain"] = [nis_domain]
-
-	# Process `memberUid` entries: One group usually has several memberUid entries. In Samba4,
-	# groups use the `member` attribute to specify all member as DNs. The members of a group
-	# will also get a `memberOf` attribute. Instead of modifying all users and converting user UIDs
-	# to DNs, the simpler solution is to let samba-tool take care of that by generating a shell script
-	# that establishes group membership. We can keep the memberUid attribute and also add that to Samba4.
-	if "memberUid" in group:
-		for uid in group["memberUid"]:
-			print("samba-tool group addmembers \"" + target + "\" \"" + uid + "\"", file = outfile_script)
-		del group["memberUid"]
-
-	# Look for nested (children) groups
-	# Only if the child group is also being migrated / merged, it will be added as
-	# a member to this group.
-	if "apple-group-nestedgroup" in group:
-		for nested in group["apple-group-nestedgroup"]:
-			for child in od_groups:
-				if child["apple-generateduid"][0] == nested:
-					print("--> Has child: " + child["cn"][0])
-					print("samba-tool group addmembers \"" + target + "\" \""
-							+ groupactions[child["cn"][0]]["target"] + "\"", file = outfile_script)
-
-	# Merge group: Change gidNumber and msSFU30* attributes; description, name and
-	# objectGUID of existing AD group stay the same.
-	if actiontype == "merge":
-		print("changetype: modify", file = outfile_ldif)
-		write_replace(outfile_ldif, "msSFU30Name", target)
-		write_replace(outfile_ldif, "msSFU30NisDomain", nis_domain)
-		write_replace(outfile_ldif, "gidNumber", group["gidNumber"][0])
-
-	# Migrate group: Add new group including all group properties
-	elif actiontype == "migrate":
-		print("changetype: add", file = outfile_ldif)
-		print("cn: " + target, file = outfile_ldif)
-		print("objectclass: top", file = outfile_ldif)
-		print("objectclass: group", file = outfile_ldif)
-		print("gidNumber: " + group["gidNumber"][0], file = outfile_ldif)
-		print("sAMAccountName: " + target, file = outfile_ldif)
-		print("msSFU30Name: " + target, file = outfile_ldif)
-		print("msSFU30NisDomain: " + nis_domain, file = outfile_ldif)
-		if "apple-group-realname" in group:
-			print("description: " + group["apple-group-realname"][0], file=outfile_ldif)
-
-		# Use `apple-generateduid` as `objectGUID` when migrating
-		print("objectGUID: " + group["apple-generateduid"][0], file=outfile_ldif)
-	else:
-		print(group["cn"][0] + ": Invalid group action type: " + actiontype)
-		quit()
-
-	print(file = outfile_ldif)
-	od_count += 1
-
-# If -a / --amend-nis-props was specified (otherwise samba4_sysgroups is empty):
-# Add gidNumber and NIS properties to all preexisting Samba4 groups, ignore groups that are marked for
-# migration or merger in groups.json input file (group_is_manual is set in this case)
-sysgroup_count = 0
-for sysgroup_cn, sysgroup_rid in samba4_sysgroups.iteritems():
-	group_is_manual = False
-
-	for odgroup, groupprops in groupactions.iteritems():
-		if groupprops["target"] == sysgroup_cn:
-			group_is_manual = True
+# LDIF modify operations that set NIS name, NIS domain and gidNumber of an existing Samba4 group
+def nis_replace(name, nis_domain, gidNumber):
+	return [("replace", "msSFU30Name", [name]), ("replace", "msSFU30NisDomain", [nis_domain]), ("replace", "gidNumber", [gidNumber])]
+
+def main(args = None, context = None):
+	# Parse command line options
+	parser = OptionParser()
+	parser.add_option("-a", "--amend-nis-props", action="store_true", default = False, help = "Amend NIS Domain, NIS Name and gidNumber attribute to existing AD system groups")
+	parser.add_option("--profile", default = None, metavar = "FILE", help = "Run under cProfile and write the stats to FILE")
+	(cmdline_opts, args) = parser.parse_args(args)
+	metrics.start_profile(cmdline_opts.profile)
+
+	# Configuration and connections, shared with the other stages if run by od2samba4.py
+	context = context or Context()
+	config = context.config
+
+	outfile_ldif_name = config.get("files", "groups_ldif")
+	outfile_membership_name = config.get("files", "membership_ldif")
+	od_dc = config.get("opendirectory", "dc")
+	od_page_size = get_page_size(config, "opendirectory")
+	samba4_dc = config.get("samba4", "dc")
+	nis_domain = config.get("samba4", "nis_domain")
+
+	# Record metrics of this stage (only written if metrics_dir is configured)
+	stage = metrics.Stage("convert_groups", config)
+
+	# Parse JSON that defines what to do with groups (migrate or merge)
+	groupactions = json.loads(open("groups.json", "r").read())
+
+	# Connect to Open Directory and to Samba4 (in order to resolve group members to DNs), unless already connected.
+	# The OD bind is sent asynchronously, so that it overlaps with connecting to Samba4.
+	context.connect_od()
+	context.samba()
+
+	# Start the OD searches first: search_od sends its requests asynchronously, so its round trips
+	# overlap with refreshing the local snapshot of Samba4 users and groups (see od2s4/sambacache.py).
+	# The uids of all OD users are needed to tell users that convert_users.py adds from unknown members.
+	od_results = context.search_od("cn=groups," + od_dc, ldap.SCOPE_SUBTREE, "(objectclass=posixGroup)", GROUPATTRIBUTES, od_page_size)
+	od_user_results = context.search_od("cn=users," + od_dc, ldap.SCOPE_SUBTREE, "(objectclass=person)", ["uid"], od_page_size)
+	samba_snapshot = context.samba_snapshot()
+
+	# Build uid -> DN index of all users known to Samba4
+	samba_uid2dn = {}
+	for dn, user in samba_snapshot.users():
+		if "uid" in user:
+			samba_uid2dn[user["uid"][0]] = dn
+	print("Retrieved list of " + str(len(samba_uid2dn)) + " existing users from Samba4")
+
+	# Users that are not in Samba4 yet, but will be added by convert_users.py (e.g. during the initial migration,
+	# where memberships are imported after users, or new users in sync.sh)
+	od_new_uids = set()
+	for dn, attributes in od_user_results:
+		uid = attributes.get("uid", [None])[0]
+		if uid is not None and not uid in samba_uid2dn and isMigrated(uid):
+			od_new_uids.add(uid)
+
+	# Build cn -> DN and cn -> current members (lowercase DNs) indices of all groups known to Samba4.
+	# If command line option -a / --amend-nis-props is used, amend existing samba groups with NIS Domain, NIS Name and a gidNumber matching
+	# the group's RID + 1e8 (= last Block of objectSid = number used for primaryGroupID), samba4_sysgroups maps the group's cn to its RID.
+	samba_group2dn = {}
+	samba_group2members = {}
+	samba4_sysgroups = {}
+	for dn, sysgroup in samba_snapshot.groups():
+		samba_group2dn[sysgroup["cn"][0]] = dn
+		samba_group2members[sysgroup["cn"][0]] = set(m.lower() for m in sysgroup.get("member", []))
+		if cmdline_opts.amend_nis_props:
+			samba4_sysgroups[sysgroup["cn"][0]] = struct.unpack("<i", sysgroup["objectSid"][0][-4:])[0]
+	print("Retrieved list of " + str(len(samba_group2dn)) + " existing groups from Samba4")
+
+	# Clean search results: Convert [(DN, attributes)] list od_results to Group records (see od2s4/records.py)
+	# Delete all groups that are not going to be migrated / merged from list
+	od_groups_all = [Group.from_ldap(g[1]) for g in od_results]
+	stage.count("groups_fetched", len(od_groups_all))
+	print("Retrieved group list with " + str(len(od_groups_all)) + " entries from Open Directory")
+	od_groups = [g for g in od_groups_all if g.cn in groupactions]
+
+	# Build graph of nested groups from all OD groups (also those that are not migrated, so that
+	# transitive membership and dropped children can be determined) and warn about nesting cycles
+	group_graph = GroupGraph(od_groups_all)
+	for cycle in group_graph.cycles():
+		print("Warning: Nested groups form a cycle: " + ", ".join(sorted(cycle)))
+
+	# Index target group cn -> OD group cn, used to find Samba4 groups that are not managed by groups.json
+	target2odgroup = dict((groupprops["target"], odgroup) for odgroup, groupprops in groupactions.iteritems())
+
+	# Target groups that are added to Samba4 by this run
+	migrated_targets = set(groupactions[g.cn]["target"] for g in od_groups if groupactions[g.cn]["type"] == "migrate")
+
+	# Users and groups that are not in Samba4 yet, but are added by convert_users.py / this script, are expected at the
+	# DN that will be assigned to them. Returns None for all other users and groups: Samba4 rejects the whole modify
+	# record of a group if a single member doesn't exist, so such members are skipped (see addMember()).
+	def userDN(uid):
+		if uid in samba_uid2dn:
+			return samba_uid2dn[uid]
+		if uid in od_new_uids:
+			return "CN=" + uid + ",CN=Users," + samba4_dc
+		return None
+
+	def groupDN(cn):
+		if cn in samba_group2dn:
+			return samba_group2dn[cn]
+		if cn in migrated_targets:
+			return "CN=" + cn + ",CN=Users," + samba4_dc
+		return None
+
+	# Collect new members of every target group. Members that are already in the group's `member`
+	# attribute on Samba4 or have already been added are skipped, so that only missing memberships
+	# are written. membership_targets keeps the target groups in order of appearance.
+	membership_targets = []
+	membership_new = {}
+	def addMember(target, member_dn, member):
+		if not target in membership_new:
+			membership_targets.append(target)
+			membership_new[target] = []
+		if member_dn is None:
+			print("--> Skipping member " + member + ", which is neither in Samba4 nor added by this migration")
+			stage.count("members_skipped")
+			return
+		members = samba_group2members.setdefault(target, set())
+		if not member_dn.lower() in members:
+			members.add(member_dn.lower())
+			membership_new[target].append(member_dn)
+
+	# Generate LDIF for import into Samba4 via ldbadd
+	outfile_ldif = LDIFWriter(outfile_ldif_name, journal = context.journal())
+	od_count = 0
+	for group in od_groups:
+		if not group.cn in groupactions:
 			continue
 
-	if not group_is_manual:
-		print("dn: CN=" + sysgroup_cn + ",CN=Users," + samba4_dc, file = outfile_ldif)
-		print("changetype: modify", file = outfile_ldif)
-		write_replace(outfile_ldif, "msSFU30Name", sysgroup_cn)
-		write_replace(outfile_ldif, "msSFU30NisDomain", nis_domain)
-		write_replace(outfile_ldif, "gidNumber", str(int(sysgroup_rid + 1e8)))
-		print(file = outfile_ldif)
-		sysgroup_count += 1
-
-outfile_ldif.close()
-outfile_script.close()
-os.chmod(outfile_script_name, os.stat(outfile_script_name).st_mode | stat.S_IEXEC)
-
-print("Extracted " + str(od_count) + " groups from Open Directory into " + outfile_ldif_name +  ".")
-print("Amended " + str(sysgroup_count) + " groups from Samba4 with NIS properties.")
-print("Copy this file to the samba4 server and import groups by executing")
-print("# ldbmodify -H /var/lib/samba/private/sam.ldb " + outfile_ldif_name + " --relax")
-print("Generated " + outfile_script_name + " for establishing group membership.")
-print("Copy this script to the samba4 server and apply memberships by executing it.")
+		print("Processing group " + group.cn + " (" + str(len(group.memberUid)) + " direct members, "
+				+ str(group_graph.transitive_member_count(group.cn)) + " including nested groups)")
+
+		target = groupactions[group.cn]["target"]
+		actiontype = groupactions[group.cn]["type"]
+
+		dn = "CN=" + target + ",CN=Users," + samba4_dc
+
+		# Process `memberUid` entries: One group usually has several memberUid entries. In Samba4,
+		# groups use the `member` attribute to specify all member as DNs. The members of a group
+		# will get a `memberOf` attribute automatically. UIDs are converted to DNs using the uid -> DN index
+		# and all missing members of a group are added with a single modify operation in the membership LDIF.
+		for uid in group.memberUid:
+			addMember(target, userDN(uid), uid)
+
+		# Look for nested (children) groups
+		# Only if the child group is also being migrated / merged, it will be added as
+		# a member to this group.
+		for child in group_graph.children[group.cn]:
+			if child in groupactions:
+				print("--> Has child: " + child)
+				addMember(target, groupDN(groupactions[child]["target"]), "group " + groupactions[child]["target"])
+			else:
+				print("--> Dropping child " + child + ", which is not in groups.json")
+		for nested in group_graph.unresolved[group.cn]:
+			print("--> Dropping unknown child group " + nested)
+
+		# Merge group: Change gidNumber and msSFU30* attributes; description, name and
+		# objectGUID of existing AD group stay the same.
+		if actiontype == "merge":
+			outfile_ldif.modify(dn, nis_replace(target, nis_domain, group.gidNumber))
+
+		# Migrate group: Add new group including all group properties
+		elif actiontype == "migrate":
+			attributes = [("cn", [target]), ("objectclass", ["top", "group"]), ("gidNumber", [group.gidNumber]),
+					("sAMAccountName", [target]), ("msSFU30Name", [target]), ("msSFU30NisDomain", [nis_domain])]
+			if group.realname is not None:
+				attributes.append(("description", [group.realname]))
+
+			# Use `apple-generateduid` as `objectGUID` when migrating
+			attributes.append(("objectGUID", [group.generateduid]))
+			outfile_ldif.add(dn, attributes)
+		else:
+			sys.exit(group.cn + ": Invalid group action type: " + actiontype)
+
+		od_count += 1
+		stage.count("groups_emitted")
+
+	# If -a / --amend-nis-props was specified (otherwise samba4_sysgroups is empty):
+	# Add gidNumber and NIS properties to all preexisting Samba4 groups, ignore groups that are marked for
+	# migration or merger in groups.json input file (group_is_manual is set in this case)
+	sysgroup_count = 0
+	for sysgroup_cn, sysgroup_rid in samba4_sysgroups.iteritems():
+		group_is_manual = sysgroup_cn in target2odgroup
+
+		if not group_is_manual:
+			outfile_ldif.modify("CN=" + sysgroup_cn + ",CN=Users," + samba4_dc, nis_replace(sysgroup_cn, nis_domain, str(int(sysgroup_rid + 1e8))))
+			sysgroup_count += 1
+			stage.count("groups_amended")
+
+	outfile_ldif.close()
+
+	# Generate LDIF that adds all missing members to groups, one modify operation per group
+	outfile_membership = LDIFWriter(outfile_membership_name, journal = context.journal())
+	membership_count = 0
+	for target in membership_targets:
+		if not membership_new[target]:
+			continue
+		if groupDN(target) is None:
+			print("Skipping members of group " + target + ", which is neither in Samba4 nor added by this migration")
+			continue
+
+		outfile_membership.modify(groupDN(target), [("add", "member", membership_new[target])])
+		membership_count += len(membership_new[target])
+		stage.count("memberships_added", len(membership_new[target]))
+	outfile_membership.close()
+
+	print("Extracted " + str(od_count) + " groups from Open Directory into " + outfile_ldif_name +  ".")
+	print("Amended " + str(sysgroup_count) + " groups from Samba4 with NIS properties.")
+	print("Copy this file to the samba4 server and import groups by executing")
+	print("# ldbmodify -H /var/lib/samba/private/sam.ldb " + outfile_ldif_name + " --relax")
+	print("Generated " + outfile_membership_name + " with " + str(membership_count) + " new group memberships.")
+	print("Copy this file to the samba4 server and apply memberships (after importing users) by executing")
+	print("# ldbmodify -H /var/lib/samba/private/sam.ldb " + outfile_membership_name)
+
+	stage.finish()
 
+if __name__ == "__main__":
+	main()
@@ -6,131 +6,206 @@
 # are not found in the hashes file will remain unchanged.
 
 from __future__ import print_function
-from ConfigParser import RawConfigParser
-import subprocess
-import string
-import ldap
+from optparse import OptionParser
+from kerberos2supplementalCredentials import build_supplementalCredentials
+from od2s4 import metrics
+from od2s4.context import Context
+from od2s4.hashstore import HashStore
+from od2s4.ldifwriter import LDIFWriter, modify_record
+import multiprocessing
+import itertools
+import binascii
+import hashlib
 import json
 import math
 import time
 import sys
 import os
 
-k2sc_path = os.path.dirname(os.path.realpath(__file__))
-
-# Parse configuration
-config = RawConfigParser()
-config.read("od2samba4.conf")
-
-samba4_dc = config.get("samba4", "dc")
-samba4_url = config.get("samba4", "url")
-samba4_username = config.get("samba4", "username")
-samba4_password = config.get("samba4", "password")
-hashes_filename = config.get("files", "hashes")
-outfile_filename = config.get("files", "hashes_ldif")
-
-# Parse username / hash directory from JSON
-injson = json.loads(open(hashes_filename, "r").read())
-
-# Use certificates only for encryption, not authentication (self-signed)
-ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
-
-# Get user list from Samba4 server
-# samba.search_s returns a key-value dictionary dc:uid. We want uid:dc so
-# that we can use the uid to find the corresponding hash in JSON hashes file.
-samba = ldap.initialize(samba4_url)
-samba.set_option(ldap.OPT_REFERRALS, 0)
-samba.start_tls_s()
-samba.simple_bind_s("cn=" + samba4_username + ",cn=Users," + samba4_dc, samba4_password)
-samba_results = samba.search_s("cn=Users," + samba4_dc, ldap.SCOPE_SUBTREE, "(objectclass=person)", ["uid"])
-userlist = [(u[1]["uid"][0], u[0]) for u in samba_results if "uid" in u[1]]
-
 # The pwdLastSet time format is an integer that counts the number of 100ns intervals since January 1, 1601 UTC.
-# Convert current time from unix epoch to pwdLastSetFormat.
-pwdLastSetTime = "{:.0f}".format(math.ceil(time.time() * 10000000) + 116444736000000000)
+# Set to the current time (converted from unix epoch to pwdLastSet format) by main() before users are converted.
+pwdLastSetTime = None
 
 # Associate hashes with usernames and generate hash-updating LDIF
-# `user` is a tuple (uid, dc)
-# We don't use ldif.LDIFWriter here since it sorts LDIF attributes alphabetically.
-# Samba, however, won't import the LDIF if "replace: <attribute>" isn't mentioned
-# before the attribute itself.
-outfile = open(outfile_filename, "w")
-count = 0
-
-def addModify(dn, key, value, base64=False):
-	print("dn: " + dn, file=outfile)
-	print("changetype: modify", file=outfile)
-	print("replace: " + key, file=outfile)
-
-	# base64 is specified by double colon (::) in LDIF
-	print(key + (":: " if base64 else ": ") + value, file=outfile)
-	print(file=outfile)
-
-for user in userlist:
-	if not user[0] in injson:
-		print("No hashes for user " + user[0] + " were found, ignoring.")
+# Every user gets a single modify record, in which all attributes are replaced in one operation,
+# so that Samba only has to run the password_hash module and update replication metadata once per user.
+# Password hashes are always written base64-encoded.
+BASE64_ATTRIBUTES = ("unicodePwd", "supplementalCredentials")
+
+# Generate the LDIF modify record for a single user.
+# `job` is a tuple (uid, dn, hashrecord). Returns a tuple (ldif, messages, error) where ldif is the LDIF text
+# for this user, messages is a list of informational messages and error is None or an error message.
+# This function only depends on its arguments and pwdLastSetTime, so that it can be run in worker processes.
+def convertUser(job):
+	uid, dn, hashrecord = job
+	changes = []
+	messages = []
+
+	# Enable or disable account according to HDBFlags in Heimdal dump
+	# This reads the "invalid" flag of HDBflags, see lib/hdb/hdb.asn1 in Heimdal.
+	# If this bit is set to "1", the account will stay disabled.
+	#
+	# userAccountControl = 512 means UF_NORMAL_ACCOUNT
+	# userAccountControl = 514 means UF_NORMAL_ACCOUNT and UF_ACCOUNT_DISABLE
+	# After Samba4 import, userAccountControl defaults to 548 which means the account is disabled and no password is required.
+	# If the user was enabled in Open Directory, we enable the account only now, so that the system is not vulnerable before password hash migration.
+	# If the user was disabled in Open Directory (in the kerberos dump), we set the account to disabled, but migrate all hashes.
+	flags_bin = "{0:032b}".format(hashrecord.flags)
+	account_disabled = (flags_bin[len(flags_bin) - 8] == "1")
+	changes.append(("replace", "userAccountControl", ["514" if account_disabled else "512"]))
+
+	# Add arcfour hash as "unicodePwd" attribute
+	changes.append(("replace", "unicodePwd", [binascii.unhexlify(hashrecord.type23)]))
+
+	# Convert type 1, 3, 17, 18 hashes to supplementalCredentials blob using build_supplementalCredentials from
+	# kerberos2supplementalCredentials.py. If hash types 1 and/or 3 are not provided, create a new "0" hash. This is only to make sure
+	# Samba accepts the supplementalCredentials blob when importing. supportedEncryptionTypes will be written to msDS-SupportedEncryptionTypes.
+	supportedEncryptionTypes = 0b00011100
+
+	type1 = hashrecord.type1
+	if type1 is None:
+		type1 = "0" * 16
 	else:
-		userprops = injson[user[0]]
-
-		# Enable or disable account according to HDBFlags in Heimdal dump
-		# This reads the "invalid" flag of HDBflags, see lib/hdb/hdb.asn1 in Heimdal.
-		# If this bit is set to "1", the account will stay disabled.
-		#
-		# userAccountControl = 512 means UF_NORMAL_ACCOUNT
-		# userAccountControl = 514 means UF_NORMAL_ACCOUNT and UF_ACCOUNT_DISABLE
-		# After Samba4 import, userAccountControl defaults to 548 which means the account is disabled and no password is required.
-		# If the user was enabled in Open Directory, we enable the account only now, so that the system is not vulnerable before password hash migration.
-		# If the user was disabled in Open Directory (in the kerberos dump), we set the account to disabled, but migrate all hashes.
-		flags_bin = "{0:032b}".format(int(userprops["flags"]))
-		account_disabled = (flags_bin[len(flags_bin) - 8] == "1")
-		addModify(user[1], "userAccountControl", "514" if account_disabled else "512")
-
-		# Add arcfour hash as "unicodePwd" attribute
-		addModify(user[1], "unicodePwd", userprops["type23"].decode("hex").encode("base64").replace("\n", ""), True)
-
-		# Convert type 1, 3, 17, 18 hashes to supplementalCredentials blob using kerberos2supplementalCredentials.py utility
-		# If hash types 1 and/or 3 are not provided, create a new "0" hash. This is only to make sure Samba accepts the
-		# supplementalCredentials blob when importing. supportedEncryptionTypes will be written to msDS-SupportedEncryptionTypes.
-		supportedEncryptionTypes = 0b00011100
-
-		if not "type1" in userprops:
-			userprops["type1"] = "0" * 16
-		else:
-			supportedEncryptionTypes |= 0b01
+		supportedEncryptionTypes |= 0b01
 
-		if not "type3" in userprops:
-			userprops["type3"] = "0" * 16
-		else:
-			supportedEncryptionTypes |= 0b10
+	type3 = hashrecord.type3
+	if type3 is None:
+		type3 = "0" * 16
+	else:
+		supportedEncryptionTypes |= 0b10
 
-		if len(set(userprops.keys()) & {"type1", "type3", "type17", "type18"}) != 4:
-			print("User " + user[0] + ": Not enough hashes for supplementalCredentials, ignoring supplementalCredentials")
+	if hashrecord.type17 is None or hashrecord.type18 is None:
+		messages.append("User " + uid + ": Not enough hashes for supplementalCredentials, ignoring supplementalCredentials")
+	else:
+		keys = {1 : binascii.unhexlify(type1), 3 : binascii.unhexlify(type3), 17 : binascii.unhexlify(hashrecord.type17),
+				18 : binascii.unhexlify(hashrecord.type18)}
+		try:
+			supplementalCredentials = build_supplementalCredentials(hashrecord.salt, keys)
+		except ValueError as e:
+			return (None, messages, "User " + uid + ": supplementalCredentials error: " + str(e))
+		changes.append(("replace", "supplementalCredentials", [supplementalCredentials]))
+
+	# Authentication with arcfour-hmac (23), aes128-cts-hmac-sha1-96 (17) and aes256-cts-hmac-sha1-96 (18)
+	# will always be enabled. Only enable authentication with des-cbc-md5 (3) and des-cbc-crc (1) if a valid hash
+	# was found in the kerberos dump.
+	changes.append(("replace", "msDS-SupportedEncryptionTypes", [str(supportedEncryptionTypes)]))
+
+	# Change pwdLastSet to current time. Technically, any timestamp != 0 would work if password policy is set to no expiry.
+	# The default value 0, however, will cause samba4 to ask for password renewal (NT_STATUS_PASSWORD_MUST_CHANGE).
+	# To set at least some meaningful value (since OD doesn't store pwdLastSet), set the current date.
+	changes.append(("replace", "pwdLastSet", [pwdLastSetTime]))
+
+	return (modify_record(dn, changes, BASE64_ATTRIBUTES), messages, None)
+
+# The hashes state file stores a digest of the hashes, salt, flags and DN of every user as of the last
+# successful import. Only users whose digest changed since then are converted, unless --full is given.
+# The digests of this run are written to a ".pending" file next to the state file, which has to be moved
+# over the state file once the LDIF was imported successfully (sync.sh takes care of that). This way, users
+# whose hashes failed to import will be included again next time. Without `hashes_state`, all users are converted.
+def fingerprint(dn, hashrecord):
+	return hashlib.sha1(json.dumps([dn, hashrecord.props()], sort_keys = True)).hexdigest()
+
+def main(args = None, context = None):
+	# Parse command line options
+	parser = OptionParser()
+	parser.add_option("-j", "--jobs", type = "int", default = 1, help = "Number of worker processes used for hash conversion (default: 1)")
+	parser.add_option("-f", "--full", action="store_true", default = False, help = "Convert hashes of all users, even if they haven't changed since the last import")
+	parser.add_option("--profile", default = None, metavar = "FILE", help = "Run under cProfile and write the stats to FILE")
+	(cmdline_opts, args) = parser.parse_args(args)
+	metrics.start_profile(cmdline_opts.profile)
+
+	# Configuration and connections, shared with the other stages if run by od2samba4.py
+	context = context or Context()
+	config = context.config
+
+	hashes_filename = config.get("files", "hashes")
+	outfile_filename = config.get("files", "hashes_ldif")
+	state_filename = config.get("files", "hashes_state") if config.has_option("files", "hashes_state") else None
+
+	# Record metrics of this stage (only written if metrics_dir is configured)
+	stage = metrics.Stage("convert_hashes", config)
+
+	# Open hashes file, users are looked up by username on demand (see od2s4/hashstore.py)
+	hashstore = HashStore(hashes_filename)
+
+	# Get user list from the local snapshot of the Samba4 directory (see od2s4/sambacache.py), which is
+	# brought up to date first. users() yields (dn, attributes) tuples. We want uid:dc so
+	# that we can use the uid to find the corresponding hash in the hashes file.
+	samba_snapshot = context.samba_snapshot()
+	userlist = [(u[1]["uid"][0], u[0]) for u in samba_snapshot.users() if "uid" in u[1]]
+	stage.count("users_fetched", len(userlist))
+
+	# Convert current time from unix epoch to pwdLastSet format
+	global pwdLastSetTime
+	pwdLastSetTime = "{:.0f}".format(math.ceil(time.time() * 10000000) + 116444736000000000)
+
+	state = {}
+	if state_filename and not cmdline_opts.full and os.path.exists(state_filename):
+		state = json.loads(open(state_filename, "r").read())
+
+	# Build the list of conversion jobs: `user` is a tuple (uid, dc)
+	jobs = []
+	newstate = {}
+	unchanged_count = 0
+	for user in userlist:
+		hashrecord = hashstore.get(user[0])
+		if hashrecord is None:
+			print("No hashes for user " + user[0] + " were found, ignoring.")
 		else:
-			k2sc_params = " ".join(["--" + e + " " + userprops[e] for e in set(userprops.keys()) & {"type1", "type3", "type17", "type18"}])
-			k2sc_popen = subprocess.Popen([k2sc_path + os.sep + "kerberos2supplementalCredentials.py --base64 " + userprops["salt"] + " " + k2sc_params],
-					shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-			supplementalCredentials = k2sc_popen.stdout.readlines()
-			if (not all((d in string.ascii_letters or d in string.digits or d in "+/=\n") for d in supplementalCredentials[0])):
-				sys.exit("kerberos2supplementalCredentials.py error:\n" + "".join(supplementalCredentials))
-			addModify(user[1], "supplementalCredentials", supplementalCredentials[0].replace("\n", ""), True)
-
-		# Authentication with arcfour-hmac (23), aes128-cts-hmac-sha1-96 (17) and aes256-cts-hmac-sha1-96 (18)
-		# will always be enabled. Only enable authentication with des-cbc-md5 (3) and des-cbc-crc (1) if a valid hash
-		# was found in the kerberos dump.
-		addModify(user[1], "msDS-SupportedEncryptionTypes", str(supportedEncryptionTypes))
-
-		# Change pwdLastSet to current time. Technically, any timestamp != 0 would work if password policy is set to no expiry.
-		# The default value 0, however, will cause samba4 to ask for password renewal (NT_STATUS_PASSWORD_MUST_CHANGE).
-		# To set at least some meaningful value (since OD doesn't store pwdLastSet), set the current date.
-		addModify(user[1], "pwdLastSet", pwdLastSetTime)
-
+			newstate[user[0]] = fingerprint(user[1], hashrecord)
+			if state.get(user[0]) == newstate[user[0]]:
+				unchanged_count += 1
+			else:
+				jobs.append((user[0], user[1], hashrecord))
+	hashstore.close()
+
+	stage.count("users_unchanged", unchanged_count)
+	print(str(unchanged_count) + " users with unchanged hashes skipped, " + str(len(jobs)) + " users will be converted.")
+
+	# With --jobs N, users are distributed among N worker processes. Pool.imap returns results in the
+	# order of the user list, so the output LDIF is identical to the one generated by a serial run.
+	# Workers are forked after pwdLastSetTime has been computed, so all of them use the same timestamp.
+	if cmdline_opts.jobs > 1:
+		pool = multiprocessing.Pool(cmdline_opts.jobs)
+		results = pool.imap(convertUser, jobs, chunksize = 64)
+	else:
+		pool = None
+		results = itertools.imap(convertUser, jobs)
+
+	outfile = LDIFWriter(outfile_filename, journal = context.journal())
+	count = 0
+	for ldif, messages, error in results:
+		for message in messages:
+			print(message)
+		if error:
+			if pool:
+				pool.terminate()
+			sys.exit(error)
+
+		outfile.write(ldif)
 		count += 1
+		stage.count("hashes_emitted")
 		if count % 50 == 0:
 			print("Number of converted users: " + str(count))
 
-outfile.close()
-
-print(str(count) + " password hash changes were successfully processed.")
-print("Output LDIF was written to " + outfile_filename + ". You can import this into samba4 using:")
-print("# ldbmodify " + outfile_filename + " -H /var/lib/samba/private/sam.ldb --controls=local_oid:1.3.6.1.4.1.7165.4.3.12:0")
-print("The control 1.3.6.1.4.1.7165.4.3.12 enables editing of the unicodePwd and supplementalCredentials attributes.")
+	if pool:
+		pool.close()
+		pool.join()
+	outfile.close()
+
+	if state_filename:
+		state_pending_file = open(state_filename + ".pending", "w")
+		state_pending_file.write(json.dumps(newstate, sort_keys = True))
+		state_pending_file.close()
+
+	stage.finish()
+	print(str(count) + " password hash changes were successfully processed.")
+	print("Output LDIF was written to " + outfile_filename + ". You can import this into samba4 using:")
+	print("# ldbmodify " + outfile_filename + " -H /var/lib/samba/private/sam.ldb --controls=local_oid:1.3.6.1.4.1.7165.4.3.12:0")
+	print("The control 1.3.6.1.4.1.7165.4.3.12 enables editing of the unicodePwd and supplementalCredentials attributes.")
+	if state_filename:
+		print("After a successful import, record the imported hashes so that they will be skipped next time:")
+		print("# mv " + state_filename + ".pending " + state_filename)
+
+if __name__ == "__main__":
+	main()
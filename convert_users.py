@@ -5,36 +5,19 @@
 # since we want to keep objectGUIDs. Setting objectGUIDs of users
 # is only allowed during provisioning with `ldbadd --relax` though.
 
-from ConfigParser import RawConfigParser
 from optparse import OptionParser
 import xml.etree.ElementTree
+from od2s4.ldapsearch import get_page_size
+from od2s4.context import Context
+from od2s4.records import User
+from od2s4.ldifwriter import LDIFWriter
+from od2s4 import metrics
+import hashlib
 import struct
 import ldap
-import ldif
-
-# Parse command line options
-parser = OptionParser()
-parser.add_option("-n", "--new", action="store_true", default = False, help = "Only convert new users (users that are not in the samba4 directory)")
-(cmdline_opts, args) = parser.parse_args()
-
-# Parse configuration
-config = RawConfigParser()
-config.read("od2samba4.conf")
-
-od_password = config.get("opendirectory", "password")
-outfile_new_name = config.get("files", "newusers_ldif")
-outfile_all_name = config.get("files", "users_ldif")
-od_username = config.get("opendirectory", "username")
-od_url = config.get("opendirectory", "url")
-od_dc = config.get("opendirectory", "dc")
-samba4_dc = config.get("samba4", "dc")
-samba4_url = config.get("samba4", "url")
-samba4_username = config.get("samba4", "username")
-samba4_password = config.get("samba4", "password")
-samba4_upn_realm = config.get("samba4", "upn_realm")
-nis_domain = config.get("samba4", "nis_domain")
-
-outfile_name = (outfile_new_name if cmdline_opts.new else outfile_all_name)
+import json
+import sys
+import os
 
 USERATTRIBUTES = [
 	"cn",				# Common Name (First + Last Name)
@@ -51,60 +34,19 @@ USERATTRIBUTES = [
 	"apple-user-mailattribute"	# XML format, forwarding address is extracted
 ]
 
-# Use certificates only for encryption, not authentication (self-signed)
-ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
-
-# Connect to Open Directory
-print("Connecting to Open Directory server")
-od = ldap.initialize(od_url)
-od.simple_bind_s("uid=" + od_username + ",cn=users," + od_dc, od_password)
-
-# Connect to Samba4
-print("Connecting to Samba4 server")
-samba = ldap.initialize(samba4_url)
-samba.set_option(ldap.OPT_REFERRALS, 0)
-samba.start_tls_s()
-samba.simple_bind_s("cn=" + samba4_username + ",cn=Users," + samba4_dc, samba4_password)
-
-# Retrieve list of users from OD and clean search results:
-# - Search result is list of tuples (DN, attributes), extract attributes
-# - Remove users that should not be migrated
-od_results = od.search_s("cn=users," + od_dc, ldap.SCOPE_SUBTREE, "(objectclass=person)", USERATTRIBUTES)
-users_all = [u[1] for u in od_results]
-users_od = []
-for user in users_all:
-	if (user["uid"][0] != "root" and user["uid"][0] != "diradmin" and user["uid"][0] != "_ldap_replicator"
-			and not user["uid"][0].startswith("vpn_") and not user["uid"][0].startswith("_krb_")):
-		users_od.append(user)
-
-print("Retrieved user list with " + str(len(users_od)) + " user entries from Open Directory")
-
-# Retrieve list of groups from Samba4 - groups have to be migrated before running this script!
-# RID (the last 4 bytes in little endian byte format, usually displayed as number after the last "-")
-# of group's objectSid determines the primary group of the user. Build a dictionary that matches the
-# group's gidNumber to the right RID. Open Directory contains the user's gidNumber attribute, so we
-# can find a matching group RID for that. This RID will then be used as the user's primaryGroupID.
-# The group's RID is also known as primaryGroupToken, though that attribute doesn't actually exist
-# separately in Samba4.
-print("Building gidNumber to primaryGroupToken Dictionary for Primary Group Membership")
-samba_group_results = samba.search_s("cn=Users," + samba4_dc, ldap.SCOPE_SUBTREE, "(objectclass=group)", ["objectSid", "gidNumber"])
-gid2rid = {}
-for group in samba_group_results:
-	if "gidNumber" in group[1]:
-		gid2rid[group[1]["gidNumber"][0]] = struct.unpack("<i", group[1]["objectSid"][0][-4:])[0]
-
-# If command line option --new is used, only add new users (UIDs that are not stored on the samba4 server)
-# to output file. Connect to samba4 server to retrieve a list of registered UIDs.
-uidlist = []
-if cmdline_opts.new:
-	print("Stripping userlist from already migrated users")
-	samba_results = samba.search_s("cn=Users," + samba4_dc, ldap.SCOPE_SUBTREE, "(objectclass=person)", ["uid"])
-	uidlist = [u[1]["uid"][0] for u in samba_results if "uid" in u[1]]
-	users_od = [u for u in users_od if not (u["uid"][0] in uidlist)]
-	print(str(len(users_od)) + " new user(s) found:")
-	for u in users_od:
-		print(u["uid"][0])
-
+# Attributes of already migrated users that are updated in --incremental mode.
+# Attributes that identify the user (uid, cn, objectGUID, uidNumber, ...) are never changed.
+# gidNumber and primaryGroupID are not updated either, since Samba4 requires users to be
+# a member of their new primary group before primaryGroupID can be changed.
+USERATTRIBUTES_MUTABLE = [
+	"displayName",
+	"givenName",
+	"sn",
+	"apple-user-homeurl",
+	"unixHomeDirectory",
+	"loginShell",
+	"mail"
+]
 
 # Parse apple-user-mailattribute XML (an XML <dict>) looking for forwarding address
 # Returns False if no forwarding Address was found
@@ -115,45 +57,214 @@ def extractForwardingAddress(xmlstring):
 			return root[key + 1].text.encode("utf-8")
 	return False
 
-# Generate LDIF for import into Samba4 via ldbadd
-outfile = ldif.LDIFWriter(open(outfile_name, "wb"))
-count = 0
-for user in users_od:
-	# Use OD's UID as CN and use OD's CN as displayName
-	dn = "CN=" + user["uid"][0] + ",CN=Users," + samba4_dc
-	user["displayName"] = [user["cn"][0]]
-	user["cn"] = [user["uid"][0]]
-	user["objectclass"] = ["top", "user", "organizationalPerson", "person", "posixAccount"]
-	user["sAMAccountName"] = [user["uid"][0]]
-	user["primaryGroupID"] = [str(gid2rid[user["gidNumber"][0]])]
-	user["userPrincipalName"] = [user["uid"][0] + "@" + samba4_upn_realm]
-	user["msSFU30Name"] = [user["uid"][0]]
-	user["msSFU30NisDomain"] = [nis_domain]
-
-	# Keep `apple-generateduid` from OD, rename to `objectGUID`
-	user["objectGUID"] = [user["apple-generateduid"][0]]
-	del user["apple-generateduid"]
-
-	# If "mail" Attribute in OD is specified, use this for "mail" attribute in samba4.
-	# Otherwise, try to extract forwarding mail address from "apple-user-mailattribute".
-	if "mail" in user:
-		user["mail"] = [user["mail"][0]]
-	elif ("apple-user-mailattribute" in user) and extractForwardingAddress(user["apple-user-mailattribute"][0]):
-		user["mail"] = [extractForwardingAddress(user["apple-user-mailattribute"][0])]
-	if "apple-user-mailattribute" in user:
-		del user["apple-user-mailattribute"]
-
-	# Rename "homeDirectory" to "unixHomeDirectory", but only create attribute if it contains a valid entry (starts with "/")
-	if user["homeDirectory"][0].startswith("/"):
-		user["unixHomeDirectory"] = [user["homeDirectory"][0]]
-	del user["homeDirectory"]
-
-	# Only keep first UID attribute, discard others
-	user["uid"] = [user["uid"][0]]
-
-	outfile.unparse(dn, user)
-	count += 1
-
-print("Extracted " + str(count) + " user account details into " + outfile_name +  ".")
-print("Copy this file to the samba4 server and import users by executing")
-print("# ldbadd -H /var/lib/samba/private/sam.ldb " + outfile_name + " --relax")
+# Returns False for system and service accounts, which are never migrated (also used by convert_groups.py)
+def isMigrated(uid):
+	return (uid != "root" and uid != "diradmin" and uid != "_ldap_replicator"
+			and not uid.startswith("vpn_") and not uid.startswith("_krb_"))
+
+def main(args = None, context = None):
+	# Parse command line options
+	parser = OptionParser()
+	parser.add_option("-n", "--new", action="store_true", default = False, help = "Only convert new users (users that are not in the samba4 directory)")
+	parser.add_option("-i", "--incremental", action="store_true", default = False, help = "Only convert users that were added or changed in "
+			+ "Open Directory since the last run: new users are written like with --new, changes of existing users are written to changedusers_ldif")
+	parser.add_option("--profile", default = None, metavar = "FILE", help = "Run under cProfile and write the stats to FILE")
+	(cmdline_opts, args) = parser.parse_args(args)
+	metrics.start_profile(cmdline_opts.profile)
+
+	# Configuration and connections, shared with the other stages if run by od2samba4.py
+	context = context or Context()
+	config = context.config
+
+	outfile_new_name = config.get("files", "newusers_ldif")
+	outfile_all_name = config.get("files", "users_ldif")
+
+	# Record metrics of this stage (only written if metrics_dir is configured)
+	stage = metrics.Stage("convert_users", config)
+	od_dc = config.get("opendirectory", "dc")
+	od_page_size = get_page_size(config, "opendirectory")
+	samba4_dc = config.get("samba4", "dc")
+	samba4_upn_realm = config.get("samba4", "upn_realm")
+	nis_domain = config.get("samba4", "nis_domain")
+
+	outfile_name = (outfile_new_name if cmdline_opts.new or cmdline_opts.incremental else outfile_all_name)
+
+	# In --incremental mode, the highest modifyTimestamp of all OD users seen during the last run is kept
+	# in the users state file. Only users with a modifyTimestamp >= this high-water mark are fetched.
+	# Like with the hashes state file, the new high-water mark is written to a ".pending" file, which
+	# has to replace the state file once the output LDIFs have been imported (sync.sh takes care of that).
+	# Users whose modifyTimestamp equals the high-water mark match the filter again, so the state file also
+	# holds a fingerprint of each of these users by DN: they are skipped unless they changed again within the
+	# same second (modifyTimestamp has a resolution of one second), which changes their fingerprint.
+	od_filter = "(objectclass=person)"
+	od_attributes = USERATTRIBUTES
+	modifyTimestamp = None
+	seen = {}
+	# The state file and the changed users LDIF are only configured (and required) if --incremental is used.
+	if cmdline_opts.incremental:
+		if not config.has_option("files", "users_state") or not config.has_option("files", "changedusers_ldif"):
+			sys.exit("--incremental requires the users_state and changedusers_ldif settings in od2samba4.conf")
+		outfile_changed_name = config.get("files", "changedusers_ldif")
+		state_filename = config.get("files", "users_state")
+		state_pending_filename = state_filename + ".pending"
+		od_attributes = USERATTRIBUTES + ["modifyTimestamp"]
+		if os.path.exists(state_filename):
+			state = json.loads(open(state_filename, "r").read())
+			modifyTimestamp = state["modifyTimestamp"]
+			seen = state.get("users", {})
+		if modifyTimestamp:
+			od_filter = "(&(objectclass=person)(modifyTimestamp>=" + modifyTimestamp + "))"
+			print("Only retrieving users changed since " + modifyTimestamp)
+
+	# Connect to Open Directory and Samba4 (unless already connected). The OD bind is sent asynchronously,
+	# so that it overlaps with connecting to Samba4.
+	context.connect_od()
+	context.samba()
+
+	# Start the OD search first: search_od sends its requests asynchronously, so its round trips
+	# overlap with refreshing the local snapshot of Samba4 users and groups (see od2s4/sambacache.py).
+	# OD results are only waited for when they are processed below.
+	od_results = context.search_od("cn=users," + od_dc, ldap.SCOPE_SUBTREE, od_filter, od_attributes, od_page_size)
+	samba_snapshot = context.samba_snapshot()
+
+	# Retrieve list of groups from Samba4 - groups have to be migrated before running this script!
+	# RID (the last 4 bytes in little endian byte format, usually displayed as number after the last "-")
+	# of group's objectSid determines the primary group of the user. Build a dictionary that matches the
+	# group's gidNumber to the right RID. Open Directory contains the user's gidNumber attribute, so we
+	# can find a matching group RID for that. This RID will then be used as the user's primaryGroupID.
+	# The group's RID is also known as primaryGroupToken, though that attribute doesn't actually exist
+	# separately in Samba4.
+	print("Building gidNumber to primaryGroupToken Dictionary for Primary Group Membership")
+	gid2rid = {}
+	for group in samba_snapshot.groups():
+		if "gidNumber" in group[1]:
+			gid2rid[group[1]["gidNumber"][0]] = struct.unpack("<i", group[1]["objectSid"][0][-4:])[0]
+
+	# If command line option --new or --incremental is used, only add new users (UIDs that are not stored on the samba4 server)
+	# to output file. Use search results from samba4 server to build a uid -> DN dictionary of registered UIDs.
+	uid2dn = {}
+	if cmdline_opts.new or cmdline_opts.incremental:
+		uid2dn = dict((u[1]["uid"][0], u[0]) for u in samba_snapshot.users() if "uid" in u[1])
+
+	# OD users are processed by a pipeline of generators, so that only one user is in flight at a time:
+	# paged search -> fetchUsers -> excludeUsers -> classifyUsers -> convertUser -> LDIF output
+
+	# Convert (DN, attributes) search results to User records (see od2s4/records.py), keep track of the highest
+	# modifyTimestamp (the new high-water mark in --incremental mode) in highwater["modifyTimestamp"] and of the
+	# fingerprints of the users at this mark in highwater["users"]. Skip users that were already seen at the old mark.
+	highwater = {"modifyTimestamp" : modifyTimestamp, "users" : {}}
+	def fetchUsers(results):
+		for dn, attributes in results:
+			user = User.from_ldap(attributes)
+			if user.modifyTimestamp is not None and user.modifyTimestamp >= highwater["modifyTimestamp"]:
+				if user.modifyTimestamp > highwater["modifyTimestamp"]:
+					highwater["modifyTimestamp"] = user.modifyTimestamp
+					highwater["users"] = {}
+				fingerprint = hashlib.sha1(repr(sorted(attributes.iteritems()))).hexdigest()
+				highwater["users"][dn] = fingerprint
+				if user.modifyTimestamp == modifyTimestamp and seen.get(dn) == fingerprint:
+					stage.count("users_unchanged")
+					continue
+			yield user
+
+	# Remove users that should not be migrated
+	def excludeUsers(users):
+		for user in users:
+			if isMigrated(user.uid):
+				stage.count("users_fetched")
+				yield user
+
+	# Yields (samba_dn, user) tuples, where samba_dn is the DN of users that are already stored on the samba4
+	# server and None for new users. With --new, already migrated users are skipped; in --incremental mode they
+	# are kept as changed users.
+	def classifyUsers(users):
+		for user in users:
+			samba_dn = uid2dn.get(user.uid)
+			if samba_dn is None or cmdline_opts.incremental:
+				yield (samba_dn, user)
+
+	# Convert an OD User record to Samba4 user attributes, returns (dn, attributes) tuple, where attributes is a
+	# list of (attribute, values) tuples in the order in which they are written to the LDIF.
+	# The attribute list is only built here, right before the user is written to the LDIF.
+	# primaryGroupID is only looked up for new users (`add`), changes of existing users never write it (see
+	# USERATTRIBUTES_MUTABLE), so a changed user whose primary group isn't in Samba4 doesn't abort the run.
+	def convertUser(user, add = True):
+		# Use OD's UID as CN and use OD's CN as displayName, only keep first UID attribute, discard others
+		uid = user.uid
+		dn = "CN=" + uid + ",CN=Users," + samba4_dc
+		entry = [("objectclass", ["top", "user", "organizationalPerson", "person", "posixAccount"]), ("cn", [uid]), ("uid", [uid]),
+				("sAMAccountName", [uid]), ("userPrincipalName", [uid + "@" + samba4_upn_realm]), ("displayName", [user.cn])]
+		for attr, value in [("givenName", user.givenName), ("sn", user.sn), ("apple-user-homeurl", user.homeurl),
+				("loginShell", user.loginShell), ("gidNumber", user.gidNumber), ("uidNumber", user.uidNumber)]:
+			if value is not None:
+				entry.append((attr, [value]))
+		if add:
+			entry.append(("primaryGroupID", [str(gid2rid[user.gidNumber])]))
+		entry.append(("msSFU30Name", [uid]))
+		entry.append(("msSFU30NisDomain", [nis_domain]))
+
+		# Keep `apple-generateduid` from OD as `objectGUID`
+		entry.append(("objectGUID", [user.generateduid]))
+
+		# If "mail" Attribute in OD is specified, use this for "mail" attribute in samba4.
+		# Otherwise, try to extract forwarding mail address from "apple-user-mailattribute".
+		if user.mail is not None:
+			entry.append(("mail", [user.mail]))
+		elif user.mailattribute is not None:
+			forwardingAddress = extractForwardingAddress(user.mailattribute)
+			if forwardingAddress:
+				entry.append(("mail", [forwardingAddress]))
+
+		# Rename "homeDirectory" to "unixHomeDirectory", but only create attribute if it contains a valid entry (starts with "/")
+		if user.homeDirectory.startswith("/"):
+			entry.append(("unixHomeDirectory", [user.homeDirectory]))
+
+		return (dn, entry)
+
+	# Generate LDIF for import into Samba4 via ldbadd.
+	# In --incremental mode, also generate LDIF that replaces all mutable attributes of changed users for import via ldbmodify.
+	# Attributes that were removed in OD are replaced with an empty value list, which deletes them in Samba4.
+	outfile = LDIFWriter(outfile_name, journal = context.journal())
+	if cmdline_opts.incremental:
+		outfile_changed = LDIFWriter(outfile_changed_name, journal = context.journal())
+
+	count = 0
+	changed_count = 0
+	for samba_dn, user in classifyUsers(excludeUsers(fetchUsers(od_results))):
+		dn, entry = convertUser(user, samba_dn is None)
+		if samba_dn is None:
+			if cmdline_opts.new or cmdline_opts.incremental:
+				print("New user: " + user.uid)
+			outfile.add(dn, entry)
+			count += 1
+			stage.count("users_added")
+		else:
+			attributes = dict(entry)
+			outfile_changed.modify(samba_dn, [("replace", attr, attributes.get(attr, [])) for attr in USERATTRIBUTES_MUTABLE])
+			changed_count += 1
+			stage.count("users_changed")
+	outfile.close()
+	if cmdline_opts.incremental:
+		outfile_changed.close()
+
+	print("Retrieved " + str(stage.counts.get("users_fetched", 0)) + " user entries from Open Directory")
+	print("Extracted " + str(count) + " user account details into " + outfile_name +  ".")
+	print("Copy this file to the samba4 server and import users by executing")
+	print("# ldbadd -H /var/lib/samba/private/sam.ldb " + outfile_name + " --relax")
+
+	if cmdline_opts.incremental:
+		state_pending_file = open(state_pending_filename, "w")
+		state_pending_file.write(json.dumps(highwater, sort_keys = True))
+		state_pending_file.close()
+
+		print("Skipped " + str(stage.counts.get("users_unchanged", 0)) + " unchanged users at the previous high-water mark.")
+		print("Extracted " + str(changed_count) + " changed user account details into " + outfile_changed_name +  ".")
+		print("Import changes by executing")
+		print("# ldbmodify -H /var/lib/samba/private/sam.ldb " + outfile_changed_name)
+		print("After a successful import, record the new high-water mark so that these changes will be skipped next time:")
+		print("# mv " + state_pending_filename + " " + state_filename)
+
+	stage.finish()
+
+if __name__ == "__main__":
+	main()
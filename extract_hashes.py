@@ -2,6 +2,8 @@
 
 # Extract arcfour-hmac-md5 (RC4) hashes from MIT Kerberos, decrypt them
 # and convert them to base64 format for unicodePwd attribute in Samba4.
+# The hashes file is written in the indexed binary format of od2s4/hashstore.py,
+# use `--export-json` to additionally export the hashes in JSON Lines format.
 #
 # Extract hashes from MIT Kerberos using `kdb5_util dump -b7 dump.mit`.
 # Get the kerberos master key: File location is determined by `key_stash_file`
@@ -11,65 +13,295 @@
 # This script requires Heimdal (https://www.h5l.org/). Please change
 # `heimdal_path` in `od2samba4.conf` to the directory where the executables
 # `hprop` and `hpropd` reside.
+#
+# Instead of reading `mit_dump` from disk, the dump can be piped into this script
+# using `--dump -`, e.g. directly from `kdb5_util dump` over SSH. Dumps compressed with
+# gzip, bzip2 or xz are detected automatically and decompressed on the fly.
+#
+# If `dump_state` is configured, only principals whose keys, last password change or attributes changed
+# since the last run are passed to heimdal for decryption, the hashes of all other principals are kept
+# from the previous hashes file. If the dump didn't change at all, nothing is extracted (a dump read from a
+# file isn't even read by heimdal, a streamed dump is still read, but the hashes file isn't rewritten).
 
-from ConfigParser import RawConfigParser
+from __future__ import print_function
+from optparse import OptionParser
+from od2s4 import metrics
+from od2s4.context import Context
+from od2s4.proctrace import Tracer
+from od2s4.hashstore import HashStore, HashStoreWriter, export_json
+from od2s4.records import HashRecord
 import subprocess
+import threading
+import itertools
+import hashlib
 import string
 import json
+import sys
 import os
 
-# Parse configuration
-config = RawConfigParser()
-config.read("od2samba4.conf")
-
-mit_dump = config.get("files", "mit_dump")
-master_key = config.get("files", "master_key")
-hprop = config.get("files", "heimdal_path") + "/hprop"
-hpropd = config.get("files", "heimdal_path") + "/hpropd"
-outfile_name = config.get("files", "hashes")
-
-# Convert hashes with heimdal
-conv = subprocess.Popen([hprop + " --database=" + mit_dump + " --source=mit-dump --decrypt --master-key=" + master_key + " --stdout | " + hpropd + " -n --print"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-users = conv.stdout.readlines()
-
-# Parse heimdal output, convert from hex to base64, write output file
-count = 0
-outjson = {}
-for user in users:
-	attribs = string.split(user, " ")
-	userprops = {}
-
-	# The following types of hashes will be extracted:
-	# des-cbc-crc (type 1), des-cbc-md5 (type 3), aes128-cts-hmac-sha1-96 (type 17), aes256-cts-hmac-sha1-96 (type 18), arcfour-hmac-md5 (type 23)
-	# types 1, 3, 17, 18 will be used for the "supplementalCredentials" attribute,
-	# type 23 will be used for the "unicodePwd" attribute
-	# hashlengths stores which hashes to migrate and the length of those hashes in hexadecimal form,
-	# which will be checked to make sure the hash matches
-	hashlengths = {"1" : 16, "3" : 16, "17" : 32, "18" : 64, "23" : 32}
-
-	keys = string.split(attribs[1], ":")
-	for i, etype in enumerate(keys):
-		if etype in hashlengths:
-			if len(keys[i + 1]) == hashlengths[etype]:
-				userprops["type" + etype] = keys[i + 1]
-
-	# Change this if you don't use the NORMAL salt (see kerberos2supplementalCredentials.py for explanation)
-	principal = string.split(attribs[0], "@")
-	salt = principal[1] + principal[0]
-	username = principal[0]
-	flags = attribs[9]
-
-	if not userprops:
-		print("No hashes for user " + username + " were not found, ignoring user.")
+# Compressed dumps are recognized by their magic bytes and decompressed by external tools,
+# which also detect truncated input (e.g. if the SSH connection the dump is piped through fails)
+DECOMPRESSORS = [
+	("\x1f\x8b", ["gzip", "-dc"]),
+	("BZh", ["bzip2", "-dc"]),
+	("\xfd7zXZ\x00", ["xz", "-dc"])
+]
+
+# Fingerprint of a principal record of the MIT dump (kdb5_util dump, format version 4 or later):
+# princ, length, name length, number of tl_data, number of key_data, e_length, name, attributes, max life,
+# max renewable life, expiration, password expiration, last success, last failed, failed auth count,
+# tl_data (type, length, contents) and key_data (version, kvno, version * (type, length, contents)) fields.
+# The fingerprint covers the attributes (which contain the flags), the last password change (tl_data type 1)
+# and the encrypted keys including their kvno. Login statistics are ignored, since they change all the time.
+# Returns None if the record can't be parsed, such principals are always decrypted.
+def fingerprint(fields):
+	try:
+		n_tl_data = int(fields[3])
+		n_key_data = int(fields[4])
+		data = [fields[7]]
+		pos = 15
+		for i in range(n_tl_data):
+			if fields[pos] == "1":
+				data.append(fields[pos + 2])
+			pos += 3
+		for i in range(n_key_data):
+			key_data_end = pos + 2 + int(fields[pos]) * 3
+			data.extend(fields[pos:key_data_end])
+			pos = key_data_end
+		if pos >= len(fields):
+			return None
+	except (IndexError, ValueError):
+		return None
+	return hashlib.sha1("\t".join(data)).hexdigest()
+
+# Copy data to a child process' stdin in a separate thread, so that reading the dump,
+# decryption by heimdal and parsing its output overlap.
+def feed(head, infile, outfile, digest):
+	try:
+		outfile.write(head)
+		digest.update(head)
+		while True:
+			data = infile.read(65536)
+			if not data:
+				break
+			digest.update(data)
+			outfile.write(data)
+	finally:
+		outfile.close()
+
+# Pre-pass over the dump, run in a separate thread: Pass all principals that changed since the last run (`state`,
+# see main) and all other lines (e.g. the header) to hprop. Fingerprints of all principals are stored in
+# prepass["principals"], usernames of unchanged principals in prepass["unchanged"]. If digest is given, the
+# dump's digest is updated.
+def filterDump(lines, outfile, state, prepass, digest = None):
+	try:
+		for line in lines:
+			if digest:
+				digest.update(line)
+			fields = line.split("\t")
+			if fields[0] == "princ" and len(fields) > 6:
+				principal_fingerprint = fingerprint(fields)
+				prepass["principals"][fields[6]] = principal_fingerprint
+				if principal_fingerprint and state["principals"].get(fields[6]) == principal_fingerprint:
+					prepass["unchanged"].add(string.split(fields[6], "@")[0])
+					continue
+				prepass["changed"] += 1
+			outfile.write(line)
+		prepass["done"] = True
+	finally:
+		outfile.close()
+
+# Start streaming the gzip-compressed MIT Kerberos dump from the Open Directory server via SSH, the dump is read
+# from the stdout of the returned process. sshpass reads the password from the environment, so that it doesn't
+# show up in the process list. pipefail makes ssh exit with an error if kdb5_util fails, not only if gzip does.
+def sshDump(config, tracer):
+	env = dict(os.environ)
+	env["SSHPASS"] = config.get("opendirectory", "sshpass")
+	print("Streaming MIT Kerberos dump via SSH")
+	return tracer.Popen(["sshpass", "-e", "ssh", "-o", "StrictHostKeyChecking=no", config.get("opendirectory", "sshuser") + "@"
+			+ config.get("opendirectory", "host"), "set -o pipefail; kdb5_util dump -b7 | gzip -c"], stdout = subprocess.PIPE, env = env, close_fds = True)
+
+def main(args = None, context = None, dump_file = None):
+	# Parse command line options
+	parser = OptionParser()
+	parser.add_option("-d", "--dump", default = None, help = "Read MIT Kerberos dump from this file instead of mit_dump, use - for stdin")
+	parser.add_option("-e", "--export-json", default = None, help = "Additionally export hashes to this file in JSON Lines format (one JSON object per principal)")
+	parser.add_option("-f", "--full", action="store_true", default = False, help = "Decrypt all principals, even if they haven't changed since the last run")
+	parser.add_option("--profile", default = None, metavar = "FILE", help = "Run under cProfile and write the stats to FILE")
+	(cmdline_opts, args) = parser.parse_args(args)
+	metrics.start_profile(cmdline_opts.profile)
+
+	# Configuration, shared with the other stages if run by od2samba4.py
+	context = context or Context()
+	config = context.config
+
+	mit_dump = cmdline_opts.dump or config.get("files", "mit_dump")
+	master_key = config.get("files", "master_key")
+	hprop = config.get("files", "heimdal_path") + "/hprop"
+	hpropd = config.get("files", "heimdal_path") + "/hpropd"
+	outfile_name = config.get("files", "hashes")
+	dump_state_filename = config.get("files", "dump_state") if config.has_option("files", "dump_state") else None
+
+	# Record metrics of this stage (only written if metrics_dir is configured)
+	stage = metrics.Stage("extract_hashes", config)
+
+	# Record resource usage of the decompressor, hprop and hpropd (only written if trace_file is configured)
+	tracer = Tracer("extract_hashes", config)
+
+	# The dump state file stores the SHA-1 digest of the dump (as read, i.e. before decompression) and a
+	# fingerprint of every principal as of the last run. It is only used if the hashes file still exists.
+	state = {"digest" : None, "principals" : {}}
+	if dump_state_filename and not cmdline_opts.full and os.path.exists(dump_state_filename) and os.path.exists(outfile_name):
+		state = json.loads(open(dump_state_filename, "r").read())
+
+	# If the dump is read from a file that didn't change since the last run, there is nothing to do. A streamed dump
+	# (`--dump -` or `dump_file`) can only be compared once it was read; see below.
+	if mit_dump != "-" and state["digest"]:
+		file_digest = hashlib.sha1()
+		digest_file = open(mit_dump, "rb")
+		for data in iter(lambda: digest_file.read(65536), ""):
+			file_digest.update(data)
+		digest_file.close()
+		if file_digest.hexdigest() == state["digest"]:
+			stage.finish()
+			print("KDC dump " + mit_dump + " didn't change since the last run, " + outfile_name + " is up to date.")
+			return
+
+	# Convert hashes with heimdal
+	# hprop and hpropd are started as two separate processes connected by a pipe (instead of a shell
+	# pipeline), so that the exit status of both of them can be checked.
+	# The dump is passed to hprop via its stdin after the pre-pass; the dump is never written to disk.
+	# od2samba4.py passes the dump as `dump_file` (stdout of the SSH connection, see sshDump).
+	prepass = {"principals" : {}, "unchanged" : set(), "changed" : 0, "done" : False}
+	if dump_file is None:
+		dump_file = sys.stdin if mit_dump == "-" else open(mit_dump, "rb")
+	head = dump_file.read(6)
+	decompressor = [d[1] for d in DECOMPRESSORS if head.startswith(d[0])]
+	digest = hashlib.sha1()
+	procs = []
+	threads = []
+
+	if decompressor:
+		procs.append((decompressor[0][0], tracer.Popen(decompressor[0], stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)))
+		threads.append(threading.Thread(target=feed, args=(head, dump_file, procs[-1][1].stdin, digest)))
+		dump_lines = iter(procs[-1][1].stdout.readline, "")
+		dump_digest = None
 	else:
-		userprops["salt"] = salt
-		userprops["flags"] = attribs[9]
+		dump_lines = itertools.chain([head + dump_file.readline()], iter(dump_file.readline, ""))
+		dump_digest = digest
+
+	procs.append(("hprop", tracer.Popen([hprop, "--database=/dev/stdin", "--source=mit-dump", "--decrypt", "--master-key=" + master_key, "--stdout"],
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)))
+	threads.append(threading.Thread(target=filterDump, args=(dump_lines, procs[-1][1].stdin, state, prepass, dump_digest)))
+
+	procs.append(("hpropd", tracer.Popen([hpropd, "-n", "--print"], stdin=procs[-1][1].stdout, stdout=subprocess.PIPE, close_fds=True)))
+	procs[-2][1].stdout.close()
+	hpropd_proc = procs[-1][1]
+
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+
+	# Parse heimdal output line by line as it arrives. Records are sorted in runs in temporary files (see
+	# od2s4/hashstore.py) and the hashes store is written once heimdal succeeded (the previous hashes file is
+	# left untouched otherwise).
+	store = HashStoreWriter(outfile_name)
+	count = 0
+	for user in iter(hpropd_proc.stdout.readline, ""):
+		stage.count("principals_read")
+		attribs = string.split(user.rstrip("\n"), " ")
+		if len(attribs) < 10:
+			print("Ignoring unparseable line in hpropd output: " + user.rstrip("\n"))
+			continue
+
+		hashrecord = HashRecord()
+
+		# The following types of hashes will be extracted:
+		# des-cbc-crc (type 1), des-cbc-md5 (type 3), aes128-cts-hmac-sha1-96 (type 17), aes256-cts-hmac-sha1-96 (type 18), arcfour-hmac-md5 (type 23)
+		# types 1, 3, 17, 18 will be used for the "supplementalCredentials" attribute,
+		# type 23 will be used for the "unicodePwd" attribute
+		# hashlengths stores which hashes to migrate and the length of those hashes in hexadecimal form,
+		# which will be checked to make sure the hash matches
+		hashlengths = {"1" : 16, "3" : 16, "17" : 32, "18" : 64, "23" : 32}
+
+		keys = string.split(attribs[1], ":")
+		for i, etype in enumerate(keys):
+			if etype in hashlengths:
+				if len(keys[i + 1]) == hashlengths[etype]:
+					setattr(hashrecord, "type" + etype, keys[i + 1])
+
+		# Change this if you don't use the NORMAL salt (see kerberos2supplementalCredentials.py for explanation)
+		principal = string.split(attribs[0], "@")
+		salt = principal[1] + principal[0]
+		username = principal[0]
+
+		if all(getattr(hashrecord, hashtype) is None for hashtype in HashRecord.HASHTYPES):
+			print("No hashes for user " + username + " were not found, ignoring user.")
+		else:
+			hashrecord.username = username
+			hashrecord.salt = salt
+			hashrecord.flags = int(attribs[9])
+
+			store.add(hashrecord)
+			count += 1
+			stage.count("hashes_extracted")
+
+	# Make sure neither the decompressor nor hprop nor hpropd nor the pre-pass failed, otherwise the output could be truncated.
+	# heimdal is waited for first: If the pre-pass failed (e.g. because hprop exited early), nobody reads the decompressor's
+	# output anymore, which is closed then, so that the decompressor exits instead of blocking on a full pipe forever.
+	statuses = [(name, proc.wait()) for name, proc in reversed(procs[-2:])]
+	threads[-1].join()
+	if decompressor:
+		if not prepass["done"]:
+			procs[0][1].stdout.close()
+		statuses.append((procs[0][0], procs[0][1].wait()))
+	for thread in threads:
+		thread.join()
+	if not prepass["done"]:
+		statuses.append(("pre-pass", 1))
+	if any(status != 0 for name, status in statuses):
+		sys.exit("Extraction failed (" + ", ".join(name + " exit status " + str(status) for name, status in statuses) + "), "
+				+ outfile_name + " was not changed.")
+
+	# A streamed dump that didn't change contained no changed principals, so nothing was decrypted either:
+	# Leave the hashes file and the dump state as they are instead of rewriting them
+	if state["digest"] and digest.hexdigest() == state["digest"]:
+		stage.count("principals_unchanged", len(prepass["principals"]))
+		stage.finish()
+		print("KDC dump didn't change since the last run, " + outfile_name + " is up to date.")
+		return
+
+	# Keep hashes of unchanged principals from the previous hashes file. The store keeps the first record of every
+	# username, so hashes that were just decrypted take precedence.
+	kept = 0
+	if prepass["unchanged"]:
+		previous = HashStore(outfile_name)
+		for hashrecord in previous:
+			if hashrecord.username in prepass["unchanged"]:
+				store.add(hashrecord)
+				kept += 1
+		previous.close()
+	store.close()
+	stage.count("principals_unchanged", len(prepass["principals"]) - prepass["changed"])
+
+	if dump_state_filename:
+		dump_state_tmp_filename = dump_state_filename + ".tmp"
+		dump_state_file = open(dump_state_tmp_filename, "w")
+		dump_state_file.write(json.dumps({"digest" : digest.hexdigest(), "principals" : prepass["principals"]}, sort_keys = True))
+		dump_state_file.close()
+		os.rename(dump_state_tmp_filename, dump_state_filename)
 
-		outjson[username] = userprops
-		count += 1
+	# Export all hashes (including the ones of unchanged principals) in JSON Lines format
+	if cmdline_opts.export_json:
+		json_tmp_name = cmdline_opts.export_json + ".tmp"
+		json_file = open(json_tmp_name, "w")
+		export_json(HashStore(outfile_name), json_file)
+		json_file.close()
+		os.rename(json_tmp_name, cmdline_opts.export_json)
 
-outfile = open(outfile_name, "w")
-outfile.write(json.dumps(outjson, indent = 4))
-outfile.close()
+	stage.finish()
+	print(str(prepass["changed"]) + " of " + str(len(prepass["principals"])) + " principals were decrypted, " + str(count)
+			+ " hashes were succesfully extracted and " + str(kept) + " unchanged hashes were kept in " + outfile_name + ".")
 
-print(str(count) + " hashes were succesfully extracted and written to " + outfile_name + ".")
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python2
+
+# Import LDIF files generated by od2samba4 directly into the Samba4 database.
+# Instead of starting a separate ldbadd / ldbmodify process for every LDIF file, sam.ldb
+# is opened only once using the samba python bindings and all records are applied in
+# batched transactions of `commit_size` records. The LDIF files generated by the other
+# scripts stay available and can be inspected before importing (dry run).
+#
+# This script must be executed on the Samba4 server. Samba4 should not be running
+# (or at least not be modifying the database heavily) during the import.
+#
+# By default, files are imported in the order required for synchronization:
+# new users, changed users, password hashes and group memberships. Use the command line
+# options to select other files, e.g. --groups for the initial group migration.
+#
+# Records that can't be imported are quarantined (see importLdif) and an interrupted import resumes
+# after the last committed transaction, if `import_journal` is configured.
+#
+# openSamDB and importLdif are also used by sync_daemon.py, which keeps sam.ldb open between imports.
+
+from __future__ import print_function
+from optparse import OptionParser
+from od2s4 import metrics
+from od2s4.context import Context
+from od2s4.importjournal import ImportJournal
+import itertools
+import hashlib
+import json
+import ldb
+import sys
+import os
+from samba.samdb import SamDB
+from samba.auth import system_session
+from samba.param import LoadParm
+
+# Controls that are required to import od2samba4 LDIFs:
+# relax allows setting objectGUIDs of new users / groups (like ldbadd --relax),
+# 1.3.6.1.4.1.7165.4.3.12 = DSDB_CONTROL_BYPASS_PASSWORD_HASH_OID allows setting password hashes
+CONTROL_RELAX = "relax:0"
+CONTROL_BYPASS_PASSWORD_HASH = "local_oid:1.3.6.1.4.1.7165.4.3.12:0"
+
+# Importable files: (command line option, config key of file, controls, description)
+IMPORTS = [
+	("groups", "groups_ldif", [CONTROL_RELAX], "groups"),
+	("users", "users_ldif", [CONTROL_RELAX], "all users"),
+	("new_users", "newusers_ldif", [CONTROL_RELAX], "new users"),
+	("changed_users", "changedusers_ldif", [], "changed users"),
+	("hashes", "hashes_ldif", [CONTROL_BYPASS_PASSWORD_HASH], "password hashes"),
+	("memberships", "membership_ldif", [], "group memberships")
+]
+DEFAULT_IMPORTS = ["new_users", "changed_users", "hashes", "memberships"]
+
+# Open sam.ldb using the samba python bindings
+def openSamDB(sam_ldb):
+	return SamDB(url = sam_ldb, session_info = system_session(), lp = LoadParm())
+
+# Raised by importLdif if the import can't continue
+class ImportFailed(Exception):
+	pass
+
+def applyRecord(samdb, changetype, msg, controls):
+	if changetype == ldb.CHANGETYPE_MODIFY:
+		samdb.modify(msg, controls = controls)
+	elif changetype == ldb.CHANGETYPE_DELETE:
+		samdb.delete(msg.dn, controls = controls)
+	else:
+		# Records without changetype are adds
+		samdb.add(msg, controls = controls)
+
+# Apply all records of an LDIF file in transactions (chunks) of commit_size records
+# After every committed chunk, the number of processed records is recorded in the journal (see od2s4/importjournal.py). If an import was
+# interrupted, it resumes after the last committed chunk of the file (as long as the file didn't change), files
+# that were imported completely are skipped. Records of the first chunk after resuming that already exist
+# (the journal may not have been written after the last commit) are counted as imported.
+# Records that can't be imported are quarantined instead of aborting the import: they are appended to
+# <filename>.quarantine (which can be fixed and imported manually) and their DNs are recorded in the journal.
+# Returns (number of imported records, DNs of all quarantined records of the file), raises ImportFailed if the import
+# can't continue.
+def importLdif(samdb, filename, controls, commit_size = 500, journal = None):
+	content = open(filename, "r").read()
+	journal = journal or ImportJournal()
+	progress = journal.progress(filename, hashlib.sha1(content).hexdigest())
+	if progress["complete"]:
+		print(filename + " was already imported completely, skipping")
+		return (0, list(progress["quarantined"]))
+
+	resume = progress["records"]
+	if resume:
+		print("Resuming import of " + filename + " after record " + str(resume))
+
+	count = resume
+	imported = 0
+	chunk = []
+	chunk_quarantine = []
+	records = itertools.islice(samdb.parse_ldif(content), resume, None)
+	samdb.transaction_start()
+	try:
+		for changetype, msg in records:
+			count += 1
+			try:
+				applyRecord(samdb, changetype, msg, controls)
+				chunk.append((changetype, msg))
+			except ldb.LdbError as e:
+				if resume and count <= resume + commit_size and e.args[0] in [ldb.ERR_ENTRY_ALREADY_EXISTS, ldb.ERR_ATTRIBUTE_OR_VALUE_EXISTS]:
+					imported += 1
+				else:
+					# A failed operation may leave changes behind, so roll back the chunk and replay its successful records
+					print("Quarantining record " + str(count) + " (" + str(msg.dn) + ") of " + filename + ": " + str(e.args[-1]))
+					samdb.transaction_cancel()
+					samdb.transaction_start()
+					for replay_changetype, replay_msg in chunk:
+						applyRecord(samdb, replay_changetype, replay_msg, controls)
+					chunk_quarantine.append((changetype, msg, str(e.args[-1])))
+
+			if count % commit_size == 0:
+				samdb.transaction_commit()
+				imported += len(chunk)
+				quarantineRecords(samdb, filename, progress, chunk_quarantine)
+				progress["records"] = count
+				journal.save()
+				chunk = []
+				chunk_quarantine = []
+				samdb.transaction_start()
+	except ldb.LdbError as e:
+		samdb.transaction_cancel()
+		raise ImportFailed("Error importing " + filename + " after record " + str(count) + ": " + str(e.args[-1])
+				+ "\nThe import will resume after record " + str(progress["records"]) + " next time.")
+	samdb.transaction_commit()
+	imported += len(chunk)
+	quarantineRecords(samdb, filename, progress, chunk_quarantine)
+	progress["records"] = count
+	progress["complete"] = True
+	journal.save()
+	return (imported, list(progress["quarantined"]))
+
+# Append quarantined records (tuples of changetype, message, error) to <filename>.quarantine
+def quarantineRecords(samdb, filename, progress, records):
+	if records:
+		quarantine_file = open(filename + ".quarantine", "a")
+		for changetype, msg, error in records:
+			quarantine_file.write("# " + error.replace("\n", " ") + "\n")
+			quarantine_file.write(samdb.write_ldif(msg, changetype) + "\n")
+			progress["quarantined"].append(str(msg.dn))
+		quarantine_file.close()
+
+# Record the state of a successful import: <filename>.pending replaces the state file, so that these changes are
+# skipped next time (see convert_users.py and convert_hashes.py). Changes whose records were quarantined (DNs in
+# `quarantined`) have to be converted again:
+# - The users state only holds the modifyTimestamp high-water mark, so it isn't recorded if any user was quarantined
+# - The fingerprints of users whose hash records were quarantined are removed from the hashes state
+def commitUsersState(filename, quarantined):
+	if quarantined:
+		print("Not recording " + filename + ": " + str(len(quarantined)) + " users were quarantined and will be converted again next time")
+	else:
+		os.rename(filename + ".pending", filename)
+
+def commitHashesState(samdb, filename, quarantined):
+	if quarantined:
+		state = json.loads(open(filename + ".pending", "r").read())
+		for dn in quarantined:
+			try:
+				for msg in samdb.search(base = dn, scope = ldb.SCOPE_BASE, attrs = ["uid"]):
+					if "uid" in msg:
+						state.pop(str(msg["uid"][0]), None)
+			except ldb.LdbError:
+				pass
+		state_file = open(filename + ".pending", "w")
+		state_file.write(json.dumps(state, sort_keys = True))
+		state_file.close()
+		print("Hashes of " + str(len(quarantined)) + " quarantined users are not recorded in " + filename + " and will be converted again next time")
+	os.rename(filename + ".pending", filename)
+
+# Returns the state file `configkey` if it is configured and has a pending state, None otherwise
+def pendingState(config, configkey):
+	if config.has_option("files", configkey) and os.path.exists(config.get("files", configkey) + ".pending"):
+		return config.get("files", configkey)
+	return None
+
+# Returns the commit size from the command line or configuration
+def getCommitSize(config, commit_size = None):
+	return commit_size or (config.getint("samba4", "commit_size") if config.has_option("samba4", "commit_size") else 500)
+
+def main(args = None, context = None):
+	# Parse command line options
+	parser = OptionParser()
+	for option, configkey, controls, description in IMPORTS:
+		parser.add_option("--" + option.replace("_", "-"), action="store_true", default = False, help = "Import " + description + " (" + configkey + ")")
+	parser.add_option("-H", "--url", default = None, help = "Path to sam.ldb (default: sam_ldb setting in od2samba4.conf)")
+	parser.add_option("-c", "--commit-size", type = "int", default = None, help = "Number of records per transaction (default: commit_size setting or 500)")
+	parser.add_option("-s", "--commit-state", action="store_true", default = False, help = "After importing, record the pending users "
+			+ "and hashes state (like `mv <state>.pending <state>`), leaving out users whose records were quarantined")
+	parser.add_option("-r", "--restart", action="store_true", default = False, help = "Ignore the import journal and import the selected files from the beginning")
+	parser.add_option("--profile", default = None, metavar = "FILE", help = "Run under cProfile and write the stats to FILE")
+	(cmdline_opts, args) = parser.parse_args(args)
+	metrics.start_profile(cmdline_opts.profile)
+
+	# Configuration, shared with the other stages if run by od2samba4.py
+	context = context or Context()
+	config = context.config
+
+	sam_ldb = cmdline_opts.url or config.get("samba4", "sam_ldb")
+	commit_size = getCommitSize(config, cmdline_opts.commit_size)
+	journal = context.journal()
+
+	# Record metrics of this stage (only written if metrics_dir is configured)
+	stage = metrics.Stage("import_samba4", config)
+
+	selected = [i for i in IMPORTS if vars(cmdline_opts)[i[0]]]
+	if not selected:
+		# Files that aren't configured (e.g. changedusers_ldif if convert_users.py --incremental isn't used) are skipped
+		selected = [i for i in IMPORTS if i[0] in DEFAULT_IMPORTS and config.has_option("files", i[1])]
+
+	# Open database once for all imports
+	print("Opening " + sam_ldb)
+	samdb = openSamDB(sam_ldb)
+
+	quarantined = {}
+	for option, configkey, controls, description in selected:
+		filename = config.get("files", configkey)
+		print("Importing " + description + " from " + filename)
+		if cmdline_opts.restart:
+			journal.files.pop(filename, None)
+		try:
+			count, quarantined[option] = importLdif(samdb, filename, controls, commit_size, journal)
+		except ImportFailed as e:
+			sys.exit(str(e))
+		stage.count("records_imported", count)
+		stage.count(option + "_records_imported", count)
+		stage.count("records_quarantined", len(quarantined[option]))
+		print("Imported " + str(count) + " records")
+		if quarantined[option]:
+			print("Warning: " + str(len(quarantined[option])) + " records could not be imported and were quarantined in " + filename + ".quarantine")
+
+	# Record users and hashes state, if they were converted
+	if cmdline_opts.commit_state:
+		users_state = pendingState(config, "users_state")
+		if users_state:
+			commitUsersState(users_state, quarantined.get("new_users", []) + quarantined.get("changed_users", []))
+		hashes_state = pendingState(config, "hashes_state")
+		if hashes_state:
+			commitHashesState(samdb, hashes_state, quarantined.get("hashes", []))
+
+	stage.finish()
+
+if __name__ == "__main__":
+	main()
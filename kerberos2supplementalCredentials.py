@@ -16,6 +16,9 @@
 # See pr_to_salt.c in MIT Kerberos or krb5_get_pw_salt(...) in salt.c in Heimdal for more information / source.
 # The result supplementalCredentials blob will be printed to stdout.
 #
+# This file can also be imported as a module: build_supplementalCredentials(salt, keys) returns the packed blob,
+# which lets convert_hashes.py construct blobs in-process instead of starting one interpreter per user.
+#
 # This script does NOT encode the WDigest credentials, since those hashes cannot be obtained from Kerberos.
 # This script does NOT support random / different salts for the different hashes.
 #
@@ -43,134 +46,149 @@ hashes = [
 	{ "arg" : "type1", "name" : "des-cbc-crc", "type" : 1, "length" : 8, "ctr3" : True }
 ]
 
-# Parse command line arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("salt", help="Salt string that the hashes were created with")
-parser.add_argument("--base64", help="Output supplementalCredentials blob in base64 format", action="store_true")
-
-for props in hashes:
-	parser.add_argument("--" + props["arg"], help = "Enctype " + str(props["type"]) + " (" + props["name"] + ") hash in HEX format")
-
-args = parser.parse_args()
-
-# Make sure parameters are valid (check lengths, check if strings are hexadecimal)
-hash_specified = False
-for props in hashes:
-	if vars(args)[props["arg"]]:
-		hash_specified = True
-		assert len(binascii.unhexlify(vars(args)[props["arg"]])) == props["length"]
-		if (not all(d in string.hexdigits for d in vars(args)[props["arg"]])):
-			sys.exit("Error: Hashes must be in hexadecimal format")
-
-if not hash_specified:
-	sys.exit("Error: At least one hash must be specified. Nothing to do.")
-
-salt_blob = drsblobs.package_PrimaryKerberosString()
-salt_blob.string = args.salt
-
-# Dictionary containing property name (string) and content (a supplementalCredentialsPackage)
-properties = {}
-
-# Store type 1, 3, 17, 18 hashes in Primary:Kerberos-Newer-Keys
-# https://msdn.microsoft.com/en-us/library/cc941808.aspx
-# "ctr4" because this is a revision 4 key container
-newer_keys_list = []
-for props in hashes:
-	if vars(args)[props["arg"]]:
+# Build a supplementalCredentials blob from a salt string and a dictionary enctype (int) -> binary key.
+# Enctypes that are not in `hashes` are ignored. Returns the packed (binary) blob.
+# Raises ValueError if no usable key is given or a key has the wrong length.
+def build_supplementalCredentials(salt, keys):
+	usable = [props for props in hashes if props["type"] in keys]
+	if not usable:
+		raise ValueError("At least one hash must be specified")
+	for props in usable:
+		if len(keys[props["type"]]) != props["length"]:
+			raise ValueError("Enctype " + str(props["type"]) + " hash must be " + str(props["length"]) + " bytes long")
+
+	salt_blob = drsblobs.package_PrimaryKerberosString()
+	salt_blob.string = salt
+
+	# Dictionary containing property name (string) and content (a supplementalCredentialsPackage)
+	properties = {}
+
+	# Store type 1, 3, 17, 18 hashes in Primary:Kerberos-Newer-Keys
+	# https://msdn.microsoft.com/en-us/library/cc941808.aspx
+	# "ctr4" because this is a revision 4 key container
+	newer_keys_list = []
+	for props in usable:
 		key = drsblobs.package_PrimaryKerberosKey4()
 		key.keytype = props["type"]
-		key.value = binascii.unhexlify(vars(args)[props["arg"]])
+		key.value = keys[props["type"]]
 		key.value_len = props["length"]
 		newer_keys_list.append(key)
 
-newer_keys_ctr = drsblobs.package_PrimaryKerberosCtr4()
-newer_keys_ctr.num_keys = len(newer_keys_list)
-newer_keys_ctr.salt = salt_blob
-newer_keys_ctr.keys = newer_keys_list
-
-newer_keys_blob_unpacked = drsblobs.package_PrimaryKerberosBlob()
-newer_keys_blob_unpacked.version = 4
-newer_keys_blob_unpacked.ctr = newer_keys_ctr
-newer_keys_blob = ndr_pack(newer_keys_blob_unpacked)
-
-newer_keys_package = drsblobs.supplementalCredentialsPackage()
-newer_keys_package_hex = binascii.hexlify(newer_keys_blob).upper()
-newer_keys_package.data = newer_keys_package_hex
-newer_keys_package.data_len = len(newer_keys_package.data)
-newer_keys_package.name = "Primary:Kerberos-Newer-Keys"
-newer_keys_package.name_len = len(newer_keys_package.name)
-newer_keys_package.reserved = 1 # see note about this property above
-
-properties["Kerberos-Newer-Keys"] = newer_keys_package
-
-# Store type 1 and 3 hashes in Primary:Kerberos
-# https://msdn.microsoft.com/en-us/library/cc245503.aspx
-# "ctr3" because this is a revision 3 key container
-normal_keys_list = []
-for props in hashes:
-	if vars(args)[props["arg"]] and props["ctr3"]:
-		key = drsblobs.package_PrimaryKerberosKey3()
-		key.keytype = props["type"]
-		key.value = binascii.unhexlify(vars(args)[props["arg"]])
-		key.value_len = props["length"]
-		normal_keys_list.append(key)
-
-# It is possible to only specify keys 17, 18
-# Then no need to generate the old format entry
-if (len(normal_keys_list) > 0):
-	normal_keys_ctr = drsblobs.package_PrimaryKerberosCtr3()
-	normal_keys_ctr.num_keys = len(normal_keys_list)
-	normal_keys_ctr.salt = salt_blob
-	normal_keys_ctr.keys = normal_keys_list
-
-	normal_keys_blob_unpacked = drsblobs.package_PrimaryKerberosBlob()
-	normal_keys_blob_unpacked.version = 3
-	normal_keys_blob_unpacked.ctr = normal_keys_ctr
-	normal_keys_blob = ndr_pack(normal_keys_blob_unpacked)
-
-	normal_keys_package = drsblobs.supplementalCredentialsPackage()
-	normal_keys_package_hex = binascii.hexlify(normal_keys_blob).upper()
-	normal_keys_package.data = normal_keys_package_hex
-	normal_keys_package.data_len = len(normal_keys_package.data)
-	normal_keys_package.name = "Primary:Kerberos"
-	normal_keys_package.name_len = len(normal_keys_package.name)
-	normal_keys_package.reserved = 1 # see note about this property above
-
-	properties["Kerberos"] = normal_keys_package
-
-# Build packages property Blob
-# https://msdn.microsoft.com/en-us/library/cc245678.aspx
-propertynames = []
-propertydata = []
-for name, package in properties.iteritems():
-	propertynames.append(name)
-	propertydata.append(package)
-
-packages_listblob = "\0".join(propertynames).encode("utf-16le")
-
-packages_blob = drsblobs.supplementalCredentialsPackage()
-packages_blob.name = "Packages"
-packages_blob.name_len = len(packages_blob.name)
-packages_blob.data = binascii.hexlify(packages_listblob).upper()
-packages_blob.data_len = len(packages_blob.data)
-packages_blob.reserved = 2 # see note about this property above
-
-# Build supplementalCredentials blob
-# https://msdn.microsoft.com/en-us/library/cc245500.aspx
-supcred_sections = [packages_blob]
-supcred_sections.extend(propertydata)
-
-supcred_subblock = drsblobs.supplementalCredentialsSubBlob()
-supcred_subblock.packages = supcred_sections
-supcred_subblock.num_packages = len(supcred_sections)
-supcred_subblock.prefix = drsblobs.SUPPLEMENTAL_CREDENTIALS_PREFIX
-supcred_subblock.signature = drsblobs.SUPPLEMENTAL_CREDENTIALS_SIGNATURE
-
-supcred_blob_unpacked = drsblobs.supplementalCredentialsBlob()
-supcred_blob_unpacked.sub = supcred_subblock
-supcred_blob = ndr_pack(supcred_blob_unpacked)
-
-if args.base64:
-	print(binascii.b2a_base64(supcred_blob))
-else:
-	print(supcred_blob)
+	newer_keys_ctr = drsblobs.package_PrimaryKerberosCtr4()
+	newer_keys_ctr.num_keys = len(newer_keys_list)
+	newer_keys_ctr.salt = salt_blob
+	newer_keys_ctr.keys = newer_keys_list
+
+	newer_keys_blob_unpacked = drsblobs.package_PrimaryKerberosBlob()
+	newer_keys_blob_unpacked.version = 4
+	newer_keys_blob_unpacked.ctr = newer_keys_ctr
+	newer_keys_blob = ndr_pack(newer_keys_blob_unpacked)
+
+	newer_keys_package = drsblobs.supplementalCredentialsPackage()
+	newer_keys_package_hex = binascii.hexlify(newer_keys_blob).upper()
+	newer_keys_package.data = newer_keys_package_hex
+	newer_keys_package.data_len = len(newer_keys_package.data)
+	newer_keys_package.name = "Primary:Kerberos-Newer-Keys"
+	newer_keys_package.name_len = len(newer_keys_package.name)
+	newer_keys_package.reserved = 1 # see note about this property above
+
+	properties["Kerberos-Newer-Keys"] = newer_keys_package
+
+	# Store type 1 and 3 hashes in Primary:Kerberos
+	# https://msdn.microsoft.com/en-us/library/cc245503.aspx
+	# "ctr3" because this is a revision 3 key container
+	normal_keys_list = []
+	for props in usable:
+		if props["ctr3"]:
+			key = drsblobs.package_PrimaryKerberosKey3()
+			key.keytype = props["type"]
+			key.value = keys[props["type"]]
+			key.value_len = props["length"]
+			normal_keys_list.append(key)
+
+	# It is possible to only specify keys 17, 18
+	# Then no need to generate the old format entry
+	if (len(normal_keys_list) > 0):
+		normal_keys_ctr = drsblobs.package_PrimaryKerberosCtr3()
+		normal_keys_ctr.num_keys = len(normal_keys_list)
+		normal_keys_ctr.salt = salt_blob
+		normal_keys_ctr.keys = normal_keys_list
+
+		normal_keys_blob_unpacked = drsblobs.package_PrimaryKerberosBlob()
+		normal_keys_blob_unpacked.version = 3
+		normal_keys_blob_unpacked.ctr = normal_keys_ctr
+		normal_keys_blob = ndr_pack(normal_keys_blob_unpacked)
+
+		normal_keys_package = drsblobs.supplementalCredentialsPackage()
+		normal_keys_package_hex = binascii.hexlify(normal_keys_blob).upper()
+		normal_keys_package.data = normal_keys_package_hex
+		normal_keys_package.data_len = len(normal_keys_package.data)
+		normal_keys_package.name = "Primary:Kerberos"
+		normal_keys_package.name_len = len(normal_keys_package.name)
+		normal_keys_package.reserved = 1 # see note about this property above
+
+		properties["Kerberos"] = normal_keys_package
+
+	# Build packages property Blob
+	# https://msdn.microsoft.com/en-us/library/cc245678.aspx
+	propertynames = []
+	propertydata = []
+	for name, package in properties.iteritems():
+		propertynames.append(name)
+		propertydata.append(package)
+
+	packages_listblob = "\0".join(propertynames).encode("utf-16le")
+
+	packages_blob = drsblobs.supplementalCredentialsPackage()
+	packages_blob.name = "Packages"
+	packages_blob.name_len = len(packages_blob.name)
+	packages_blob.data = binascii.hexlify(packages_listblob).upper()
+	packages_blob.data_len = len(packages_blob.data)
+	packages_blob.reserved = 2 # see note about this property above
+
+	# Build supplementalCredentials blob
+	# https://msdn.microsoft.com/en-us/library/cc245500.aspx
+	supcred_sections = [packages_blob]
+	supcred_sections.extend(propertydata)
+
+	supcred_subblock = drsblobs.supplementalCredentialsSubBlob()
+	supcred_subblock.packages = supcred_sections
+	supcred_subblock.num_packages = len(supcred_sections)
+	supcred_subblock.prefix = drsblobs.SUPPLEMENTAL_CREDENTIALS_PREFIX
+	supcred_subblock.signature = drsblobs.SUPPLEMENTAL_CREDENTIALS_SIGNATURE
+
+	supcred_blob_unpacked = drsblobs.supplementalCredentialsBlob()
+	supcred_blob_unpacked.sub = supcred_subblock
+	return ndr_pack(supcred_blob_unpacked)
+
+if __name__ == "__main__":
+	# Parse command line arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument("salt", help="Salt string that the hashes were created with")
+	parser.add_argument("--base64", help="Output supplementalCredentials blob in base64 format", action="store_true")
+
+	for props in hashes:
+		parser.add_argument("--" + props["arg"], help = "Enctype " + str(props["type"]) + " (" + props["name"] + ") hash in HEX format")
+
+	args = parser.parse_args()
+
+	# Make sure parameters are valid (check if strings are hexadecimal), lengths are checked by build_supplementalCredentials
+	keys = {}
+	for props in hashes:
+		if vars(args)[props["arg"]]:
+			if (not all(d in string.hexdigits for d in vars(args)[props["arg"]])):
+				sys.exit("Error: Hashes must be in hexadecimal format")
+			keys[props["type"]] = binascii.unhexlify(vars(args)[props["arg"]])
+
+	if not keys:
+		sys.exit("Error: At least one hash must be specified. Nothing to do.")
+
+	try:
+		supcred_blob = build_supplementalCredentials(args.salt, keys)
+	except ValueError as e:
+		sys.exit("Error: " + str(e))
+
+	if args.base64:
+		print(binascii.b2a_base64(supcred_blob))
+	else:
+		print(supcred_blob)
@@ -0,0 +1 @@
+# Shared modules used by the od2samba4 scripts
@@ -0,0 +1,79 @@
+# Configuration and server connections shared by the od2samba4 stages.
+# od2samba4.py runs several stages in a single process and passes the same Context to all of them, so that
+# od2samba4.conf is only parsed once and there is only one bound connection per server (including StartTLS).
+# Connections are only established when a stage first needs them and python-ldap is only imported then,
+# so that stages which don't use LDAP (extract_hashes.py, import_samba4.py) don't load it.
+# When a script is run on its own, it creates its own Context.
+
+from __future__ import print_function
+from ConfigParser import RawConfigParser
+
+def _ldap():
+	import ldap
+
+	# Use certificates only for encryption, not authentication (self-signed)
+	ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
+	return ldap
+
+class Context(object):
+	def __init__(self, config_filename = "od2samba4.conf"):
+		self.config = RawConfigParser()
+		self.config.read(config_filename)
+		self._od = None
+		self._samba = None
+		self._snapshot = None
+		self._journal = None
+
+		# Configurations from before the membership LDIF replaced the ldbmodify shell script name the file membership_script
+		if self.config.has_option("files", "membership_script") and not self.config.has_option("files", "membership_ldif"):
+			self.config.set("files", "membership_ldif", self.config.get("files", "membership_script"))
+
+	# Start connecting to Open Directory (or its replicas, see od2s4/replicas.py). Binds are sent asynchronously,
+	# so that they overlap with connecting to Samba4; od() waits for their results.
+	def connect_od(self):
+		if self._od is None:
+			_ldap()
+			from od2s4.replicas import ReplicaPool
+			self._od = ReplicaPool(self.config)
+		self._od.connect()
+
+	# Bound connection to the Open Directory server used for searches
+	def od(self):
+		self.connect_od()
+		return self._od.conn()
+
+	# Paged search on Open Directory that fails over to another replica if the server fails
+	def search_od(self, base, scope, filterstr, attrlist, page_size):
+		self.connect_od()
+		return self._od.search(base, scope, filterstr, attrlist, page_size)
+
+	# Bound connection to Samba4 (StartTLS)
+	def samba(self):
+		if self._samba is None:
+			print("Connecting to Samba4 server")
+			ldap = _ldap()
+			self._samba = ldap.initialize(self.config.get("samba4", "url"))
+			self._samba.set_option(ldap.OPT_REFERRALS, 0)
+			self._samba.start_tls_s()
+			self._samba.simple_bind_s("cn=" + self.config.get("samba4", "username") + ",cn=Users," + self.config.get("samba4", "dc"),
+					self.config.get("samba4", "password"))
+		return self._samba
+
+	# Local snapshot of Samba4 users and groups (see od2s4/sambacache.py), refreshed on every call
+	def samba_snapshot(self):
+		if self._snapshot is None:
+			from od2s4.ldapsearch import get_page_size
+			from od2s4.sambacache import open_snapshot
+			self._snapshot = open_snapshot(self.samba(), self.config, get_page_size(self.config, "samba4"))
+		else:
+			count = self._snapshot.refresh()
+			print("Samba4 snapshot refreshed, " + str(count) + " changed users and groups fetched")
+		return self._snapshot
+
+	# Import journal (see od2s4/importjournal.py), shared by the conversion scripts, which discard the entries of the
+	# LDIF files they write, and import_samba4.py
+	def journal(self):
+		if self._journal is None:
+			from od2s4.importjournal import ImportJournal
+			self._journal = ImportJournal(self.config.get("files", "import_journal") if self.config.has_option("files", "import_journal") else None)
+		return self._journal
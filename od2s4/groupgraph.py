@@ -0,0 +1,125 @@
+# Graph of nested Open Directory groups.
+# Open Directory stores nested groups as `apple-group-nestedgroup` attributes that contain the
+# `apple-generateduid` of the child group. GroupGraph resolves these references once using a
+# generateduid -> cn index, so that looking up the children of a group doesn't require scanning all groups.
+# Strongly connected components (Tarjan's algorithm) are used to detect nesting cycles and to compute
+# transitive group membership in time linear in the number of groups, nesting references and members.
+
+class GroupGraph(object):
+	# `groups` is a list of OD Group records (see od2s4/records.py)
+	def __init__(self, groups):
+		self.groups = {}
+		guid2cn = {}
+		for group in groups:
+			self.groups[group.cn] = group
+			guid2cn[group.generateduid] = group.cn
+
+		# cn -> list of child group cns, cn -> list of nested GUIDs that don't belong to any OD group
+		self.children = {}
+		self.unresolved = {}
+		for cn, group in self.groups.iteritems():
+			self.children[cn] = []
+			self.unresolved[cn] = []
+			for nested in group.nestedgroups:
+				if nested in guid2cn:
+					self.children[cn].append(guid2cn[nested])
+				else:
+					self.unresolved[cn].append(nested)
+
+		self._findComponents()
+		self._member_counts = None
+
+	# Iterative version of Tarjan's algorithm: Assigns a component number to every group
+	# (self.component) and builds the condensed graph of components (self.component_children),
+	# which is free of cycles.
+	def _findComponents(self):
+		self.component = {}
+		self.component_groups = []
+		index = {}
+		lowlink = {}
+		onstack = set()
+		stack = []
+
+		for root in self.groups:
+			if root in index:
+				continue
+			work = [(root, 0)]
+			while work:
+				cn, i = work.pop()
+				if i == 0:
+					index[cn] = lowlink[cn] = len(index)
+					stack.append(cn)
+					onstack.add(cn)
+				if i < len(self.children[cn]):
+					work.append((cn, i + 1))
+					child = self.children[cn][i]
+					if not child in index:
+						work.append((child, 0))
+					elif child in onstack:
+						lowlink[cn] = min(lowlink[cn], index[child])
+					continue
+
+				# All children processed: propagate lowlink to parent, pop component if cn is its root
+				if work:
+					parent = work[-1][0]
+					lowlink[parent] = min(lowlink[parent], lowlink[cn])
+				if lowlink[cn] == index[cn]:
+					members = []
+					while True:
+						member = stack.pop()
+						onstack.discard(member)
+						self.component[member] = len(self.component_groups)
+						members.append(member)
+						if member == cn:
+							break
+					self.component_groups.append(members)
+
+		self.component_children = []
+		for members in self.component_groups:
+			children = set()
+			for cn in members:
+				children.update(self.component[child] for child in self.children[cn])
+			children.discard(self.component[members[0]])
+			self.component_children.append(children)
+
+	# Return list of nesting cycles, every cycle is a list of group cns
+	def cycles(self):
+		return [members for members in self.component_groups
+				if len(members) > 1 or members[0] in self.children[members[0]]]
+
+	# Return number of distinct memberUids of the given group including all members of nested groups.
+	# The counts of all groups are computed on the first call. Only counts are kept: Tarjan's algorithm numbers
+	# components in reverse topological order (children first), so components are processed in that order and
+	# the member set of a component is dropped as soon as its last parent has merged it. A component takes
+	# over the set of a child it is the last parent of instead of copying it, so that long nesting chains stay linear.
+	def transitive_member_count(self, cn):
+		if self._member_counts is None:
+			self._countMembers()
+		return self._member_counts[self.component[cn]]
+
+	def _countMembers(self):
+		parents = [0] * len(self.component_groups)
+		for children in self.component_children:
+			for c in children:
+				parents[c] += 1
+
+		self._member_counts = []
+		sets = {}
+		for comp, children in enumerate(self.component_children):
+			members = None
+			for c in children:
+				parents[c] -= 1
+				if members is None and parents[c] == 0:
+					members = sets.pop(c)
+			if members is None:
+				members = set()
+			for c in children:
+				if c in sets:
+					members |= sets[c]
+					if parents[c] == 0:
+						del sets[c]
+			for member in self.component_groups[comp]:
+				members.update(self.groups[member].memberUid)
+			self._member_counts.append(len(members))
+			if parents[comp]:
+				sets[comp] = members
@@ -0,0 +1,209 @@
+# Compact on-disk store for the hashes extracted from the Kerberos dump.
+# The file consists of a header, a table of fixed-size records sorted by username and a string table
+# holding usernames and salts. Hashes are stored in binary form in fixed fields of the record.
+# HashStore opens the file using mmap and finds users by binary search over the record table, so
+# looking up a user takes O(log n) time without parsing the whole file, and neither load time nor memory
+# usage grow with the size of the realm.
+#
+# Records are HashRecord objects (see od2s4/records.py).
+
+from od2s4.records import HashRecord
+import binascii
+import tempfile
+import shutil
+import struct
+import heapq
+import mmap
+import json
+import os
+
+MAGIC = "OD2S4HS1"
+
+# Header: magic, number of records, offset of the string table
+HEADER = struct.Struct("<8sII")
+
+# Record: username offset / length and salt offset / length (in the string table), HDBFlags,
+# bitmask of the hashes that are present, hashes of type 1, 3, 17, 18, 23
+RECORD = struct.Struct("<IHIHIB8s8s16s32s16s")
+
+# A record consists of the string table references, which are only known once the records are sorted,
+# and the data (HDBFlags, bitmask, hashes), which is packed when the record is added
+RECORD_STRINGS = struct.Struct("<IHIH")
+RECORD_DATA = struct.Struct("<IB8s8s16s32s16s")
+
+# Hash types in the order in which they appear in a record, with their length in bytes
+HASHTYPES = [("type1", 8), ("type3", 8), ("type17", 16), ("type18", 32), ("type23", 16)]
+
+# Number of records that HashStoreWriter sorts in memory
+RUN_RECORDS = 1 << 16
+
+# Record of a sorted run: sequence number, length of the username and of the packed record, followed by both
+RUN_ENTRY = struct.Struct("<IHH")
+
+# Yields (username, sequence number, packed record) tuples of a run written by HashStoreWriter
+def _read_run(run):
+	while True:
+		header = run.read(RUN_ENTRY.size)
+		if not header:
+			return
+		sequence, username_length, packed_length = RUN_ENTRY.unpack(header)
+		data = run.read(username_length + packed_length)
+		yield (data[:username_length], sequence, data[username_length:])
+
+# Collects records and writes them to a new hashes store once closed.
+# Every record is packed into a single string (record data followed by the salt) as soon as it is added. Records
+# are sorted by username in runs of `run_records` records, which are written to temporary files, and merged when
+# the store is written (external merge sort), so that memory usage doesn't grow with the number of records.
+# The string table offsets are filled in when the records are written. If a username is added more than once,
+# the first record wins.
+class HashStoreWriter(object):
+	def __init__(self, filename, run_records = RUN_RECORDS):
+		self.filename = filename
+		self.run_records = run_records
+		self.records = []
+		self.runs = []
+		self.sequence = 0
+
+	def _tempfile(self):
+		return tempfile.TemporaryFile(dir = os.path.dirname(os.path.abspath(self.filename)))
+
+	# `record` is a HashRecord
+	def add(self, record):
+		present = 0
+		hashes = []
+		for i, (hashtype, length) in enumerate(HASHTYPES):
+			value = getattr(record, hashtype)
+			if value is not None:
+				value = binascii.unhexlify(value)
+				if len(value) != length:
+					raise ValueError("Invalid length of " + hashtype + " hash for user " + record.username)
+				present |= 1 << i
+				hashes.append(value)
+			else:
+				hashes.append("\0" * length)
+		self.records.append((record.username, self.sequence, RECORD_DATA.pack(int(record.flags), present, *hashes) + record.salt))
+		self.sequence += 1
+		if len(self.records) >= self.run_records:
+			self._spill()
+
+	# Sort the collected records and write them to a temporary file
+	def _spill(self):
+		self.records.sort()
+		run = self._tempfile()
+		for username, sequence, packed in self.records:
+			run.write(RUN_ENTRY.pack(sequence, len(username), len(packed)) + username + packed)
+		run.seek(0)
+		self.runs.append(run)
+		self.records = []
+
+	# Write the store to a temporary file first and replace the target file afterwards, so that
+	# readers never see a partially written file. The string table is collected in another temporary
+	# file and the header is written last, once the number of records is known.
+	def close(self):
+		if self.runs:
+			self._spill()
+			records = heapq.merge(*[_read_run(run) for run in self.runs])
+		else:
+			self.records.sort()
+			records = iter(self.records)
+
+		tmp_filename = self.filename + ".tmp"
+		outfile = open(tmp_filename, "wb", 1 << 16)
+		outfile.write(HEADER.pack(MAGIC, 0, 0))
+		strings = self._tempfile()
+		strings_length = 0
+		count = 0
+		previous = None
+		for username, sequence, packed in records:
+			if username == previous:
+				continue
+			previous = username
+			salt = packed[RECORD_DATA.size:]
+			outfile.write(RECORD_STRINGS.pack(strings_length, len(username), strings_length + len(username), len(salt)))
+			outfile.write(packed[:RECORD_DATA.size])
+			strings.write(username)
+			strings.write(salt)
+			strings_length += len(username) + len(salt)
+			count += 1
+		strings.seek(0)
+		shutil.copyfileobj(strings, outfile)
+		strings.close()
+		outfile.seek(0)
+		outfile.write(HEADER.pack(MAGIC, count, HEADER.size + RECORD.size * count))
+		outfile.close()
+		os.rename(tmp_filename, self.filename)
+		for run in self.runs:
+			run.close()
+		self.records = []
+		self.runs = []
+
+# Read-only access to a hashes store
+class HashStore(object):
+	def __init__(self, filename):
+		self.file = open(filename, "rb")
+		if os.fstat(self.file.fileno()).st_size < HEADER.size:
+			raise ValueError(filename + " is not an od2samba4 hashes file")
+		self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		magic, self.count, self.strings_offset = HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC:
+			raise ValueError(filename + " is not an od2samba4 hashes file")
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+	def __len__(self):
+		return self.count
+
+	def _record(self, index):
+		return RECORD.unpack_from(self.map, HEADER.size + RECORD.size * index)
+
+	def _string(self, offset, length):
+		return self.map[self.strings_offset + offset:self.strings_offset + offset + length]
+
+	def _username(self, index):
+		record = self._record(index)
+		return self._string(record[0], record[1])
+
+	# Binary search for the record index of `username`, None if not found
+	def _find(self, username):
+		low, high = 0, self.count
+		while low < high:
+			middle = (low + high) // 2
+			if self._username(middle) < username:
+				low = middle + 1
+			else:
+				high = middle
+		if low < self.count and self._username(low) == username:
+			return low
+		return None
+
+	def _hashrecord(self, record):
+		hashrecord = HashRecord(username = self._string(record[0], record[1]), salt = self._string(record[2], record[3]),
+				flags = record[4])
+		for i, (hashtype, length) in enumerate(HASHTYPES):
+			if record[5] & (1 << i):
+				setattr(hashrecord, hashtype, binascii.hexlify(record[6 + i]))
+		return hashrecord
+
+	def __contains__(self, username):
+		return self._find(username) is not None
+
+	# Returns the HashRecord of `username` or `default` if the user isn't in the store
+	def get(self, username, default = None):
+		index = self._find(username)
+		if index is None:
+			return default
+		return self._hashrecord(self._record(index))
+
+	# Yields HashRecords sorted by username
+	def __iter__(self):
+		for index in xrange(self.count):
+			yield self._hashrecord(self._record(index))
+
+# Export a hashes store in JSON Lines format (one JSON object per user, including the "username")
+def export_json(store, outfile):
+	for record in store:
+		userprops = record.props()
+		userprops["username"] = record.username
+		outfile.write(json.dumps(userprops, sort_keys = True) + "\n")
@@ -0,0 +1,39 @@
+# Journal of the LDIF imports of import_samba4.py.
+# The journal records the progress of every LDIF file (identified by its path and the SHA-1 digest of its content):
+# the number of records that were processed in committed transactions, whether the file was imported completely
+# and the DNs of quarantined records. If the journal file isn't configured (`import_journal` in the [files] section),
+# progress is only kept in memory.
+# The conversion scripts discard the entry of every LDIF file they write (see od2s4/ldifwriter.py), so a file that
+# is generated again is imported again, even if it contains the same records; only an incomplete import of the same
+# file is resumed.
+
+import json
+import os
+
+class ImportJournal(object):
+	def __init__(self, filename = None):
+		self.filename = filename
+		self.files = {}
+		if filename and os.path.exists(filename):
+			self.files = json.loads(open(filename, "r").read())
+
+	# Returns the progress dictionary of an LDIF file, progress of a file with different content is discarded
+	def progress(self, ldif_filename, digest):
+		progress = self.files.get(ldif_filename)
+		if progress is None or progress["digest"] != digest:
+			progress = {"digest" : digest, "records" : 0, "complete" : False, "quarantined" : []}
+			self.files[ldif_filename] = progress
+		return progress
+
+	# Discard the progress of an LDIF file, e.g. because it is generated again
+	def forget(self, ldif_filename):
+		if self.files.pop(ldif_filename, None) is not None:
+			self.save()
+
+	def save(self):
+		if self.filename:
+			tmp_filename = self.filename + ".tmp"
+			tmp_file = open(tmp_filename, "w")
+			tmp_file.write(json.dumps(self.files, indent = 4, sort_keys = True))
+			tmp_file.close()
+			os.rename(tmp_filename, self.filename)
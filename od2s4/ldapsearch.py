@@ -0,0 +1,57 @@
+# LDAP search helper using the Simple Paged Results control (RFC 2696).
+# Open Directory and Samba4 both limit the number of entries returned by a single search,
+# so large directories would be truncated by search_s. Paged searches fetch the result set
+# in pages of `page_size` entries and yield entries one by one, so that only one page is kept
+# in memory at any time.
+#
+# Searches use python-ldap's asynchronous API: The request for the first page is sent as soon
+# as the search is created and the request for the next page is sent before the entries of the
+# current page are processed. Several searches (also on the same connection) can thus be started
+# at once, their round trips overlap and results are only waited for when they are iterated.
+
+from ldap.controls import SimplePagedResultsControl
+from od2s4 import metrics
+
+# Samba4 limits pages to 1000 entries (MaxPageSize), OpenLDAP's default size limit is 500
+DEFAULT_PAGE_SIZE = 500
+
+# Read page size for the given config section (`opendirectory` or `samba4`), if configured
+def get_page_size(config, section):
+	if config.has_option(section, "page_size"):
+		return config.getint(section, "page_size")
+	return DEFAULT_PAGE_SIZE
+
+# Paged, asynchronous replacement for conn.search_s(base, scope, filterstr, attrlist)
+# Iterating a PagedSearch yields (dn, attributes) tuples. Search result references (returned by
+# AD as referrals, which have no attributes dictionary) are skipped. `serverctrls` are sent along
+# with the paged results control.
+class PagedSearch(object):
+	def __init__(self, conn, base, scope, filterstr, attrlist = None, page_size = DEFAULT_PAGE_SIZE, serverctrls = None):
+		self.conn = conn
+		self.base = base
+		self.scope = scope
+		self.filterstr = filterstr
+		self.attrlist = attrlist
+		self.page_size = page_size
+		self.serverctrls = serverctrls or []
+		self.msgid = self._request("")
+
+	def _request(self, cookie):
+		control = SimplePagedResultsControl(True, size = self.page_size, cookie = cookie)
+		metrics.ldap_round_trips += 1
+		return self.conn.search_ext(self.base, self.scope, self.filterstr, self.attrlist, serverctrls = [control] + self.serverctrls)
+
+	def __iter__(self):
+		while self.msgid is not None:
+			rtype, rdata, rmsgid, serverctrls = self.conn.result3(self.msgid)
+
+			# The server returns an empty cookie with the last page
+			cookies = [c.cookie for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
+			self.msgid = self._request(cookies[0]) if cookies and cookies[0] else None
+
+			for dn, attributes in rdata:
+				if dn is not None and isinstance(attributes, dict):
+					yield (dn, attributes)
+
+def search_paged(conn, base, scope, filterstr, attrlist = None, page_size = DEFAULT_PAGE_SIZE, serverctrls = None):
+	return PagedSearch(conn, base, scope, filterstr, attrlist, page_size, serverctrls)
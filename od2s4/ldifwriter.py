@@ -0,0 +1,94 @@
+# LDIF output (RFC 2849) of the conversion scripts.
+# Unlike ldif.LDIFWriter of python-ldap, which sorts the attributes of entries alphabetically, attributes are
+# written in the order given by the caller (Samba requires "replace: <attribute>" to precede the attribute's
+# values). Values that aren't safe strings (binary data, non-ASCII characters, leading space, colon or "<",
+# trailing space) are base64-encoded automatically, unicode values are encoded as UTF-8 first. Lines longer
+# than COLS characters are folded.
+#
+# add_record() and modify_record() return a record as string and only depend on their arguments, so that
+# records can be formatted in worker processes. LDIFWriter collects records and writes them to the file in
+# large chunks instead of line by line.
+#
+# If an import journal (see od2s4/importjournal.py) is given, the entry of the file is discarded, so that a file
+# that is generated again is imported again, even if its records didn't change.
+
+import binascii
+import re
+
+# Maximum line length, continuation lines start with a space (same as python-ldap)
+COLS = 76
+
+# Number of characters collected before they are written to the file
+BUFFER_SIZE = 1 << 16
+
+# Characters that are not allowed in a SAFE-STRING (anywhere, as first or as last character)
+_UNSAFE = re.compile(r"[\x00\n\r\x80-\xff]|^[ :<]| $")
+
+def _fold(line):
+	if len(line) <= COLS:
+		return line + "\n"
+	parts = [line[:COLS]]
+	for pos in xrange(COLS, len(line), COLS - 1):
+		parts.append(" " + line[pos:pos + COLS - 1])
+	return "\n".join(parts) + "\n"
+
+# "attr: value" line, base64-encoded ("attr:: value") if required or if `base64` is set
+def _line(attr, value, base64 = False):
+	if isinstance(value, unicode):
+		value = value.encode("utf-8")
+	if base64 or _UNSAFE.search(value):
+		return _fold(attr + ":: " + binascii.b2a_base64(value).rstrip("\n"))
+	return _fold(attr + ": " + value)
+
+# Add record, `attributes` is a list of (attribute, list of values) tuples.
+# Values of attributes in `base64_attrs` are always base64-encoded.
+def add_record(dn, attributes, base64_attrs = ()):
+	lines = [_line("dn", dn), "changetype: add\n"]
+	for attr, values in attributes:
+		for value in values:
+			lines.append(_line(attr, value, attr in base64_attrs))
+	lines.append("\n")
+	return "".join(lines)
+
+# Modify record, `changes` is a list of (operation, attribute, list of values) tuples, where operation
+# is "add", "delete" or "replace". Replacing an attribute with an empty list of values deletes it.
+def modify_record(dn, changes, base64_attrs = ()):
+	lines = [_line("dn", dn), "changetype: modify\n"]
+	for operation, attr, values in changes:
+		lines.append(operation + ": " + attr + "\n")
+		for value in values:
+			lines.append(_line(attr, value, attr in base64_attrs))
+		lines.append("-\n")
+	lines.append("\n")
+	return "".join(lines)
+
+class LDIFWriter(object):
+	def __init__(self, filename, buffer_size = BUFFER_SIZE, journal = None):
+		self.file = open(filename, "wb")
+		self.buffer_size = buffer_size
+		self.buffer = []
+		self.buffered = 0
+		if journal:
+			journal.forget(filename)
+
+	# Write a record formatted by add_record() or modify_record()
+	def write(self, record):
+		self.buffer.append(record)
+		self.buffered += len(record)
+		if self.buffered >= self.buffer_size:
+			self.flush()
+
+	def add(self, dn, attributes, base64_attrs = ()):
+		self.write(add_record(dn, attributes, base64_attrs))
+
+	def modify(self, dn, changes, base64_attrs = ()):
+		self.write(modify_record(dn, changes, base64_attrs))
+
+	def flush(self):
+		self.file.write("".join(self.buffer))
+		self.buffer = []
+		self.buffered = 0
+
+	def close(self):
+		self.flush()
+		self.file.close()
@@ -0,0 +1,138 @@
+# Per-stage metrics for monitoring od2samba4 runs (e.g. the sync timer).
+# Every script creates one Stage, which records wall time, CPU time (including child processes),
+# entry counts and LDAP round trips. When the stage finishes or the script exits (also if it fails), the
+# metrics are written to
+# - <metrics_dir>/od2samba4_<stage>.prom in Prometheus textfile collector format and
+# - <metrics_dir>/run_summary.json, a JSON summary of all stages of the current run.
+# Metrics are only written if `metrics_dir` is set in the [files] section of od2samba4.conf.
+# Stages belong to the same run if they share the OD2S4_RUN_ID environment variable (set by sync.sh).
+# With the --profile option, scripts additionally run under cProfile (see start_profile).
+
+from __future__ import print_function
+import resource
+import cProfile
+import atexit
+import json
+import time
+import os
+
+# Number of LDAP round trips, incremented by od2s4.ldapsearch for every page request
+ldap_round_trips = 0
+
+def _cputime():
+	usage_self = resource.getrusage(resource.RUSAGE_SELF)
+	usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+# Write file atomically, so that the textfile collector never reads partial files
+def _writeFile(filename, content):
+	tmp_filename = filename + ".tmp"
+	tmp_file = open(tmp_filename, "w")
+	tmp_file.write(content)
+	tmp_file.close()
+	os.rename(tmp_filename, filename)
+
+def _dumpProfile(profile, filename):
+	profile.disable()
+	profile.dump_stats(filename)
+	print("Profile written to " + filename + ", view it using: python2 -m pstats " + filename)
+
+# Run the rest of the script under cProfile if `filename` is set (--profile option of the scripts) and write
+# the stats to `filename` when the script exits. Only the main process is profiled, not worker processes.
+def start_profile(filename):
+	if filename:
+		profile = cProfile.Profile()
+		atexit.register(_dumpProfile, profile, filename)
+		profile.enable()
+
+# Stages that haven't been closed yet, they are written when the process exits or by close_stages()
+_open_stages = set()
+
+# Close all open stages, e.g. after a stage failed in a long-running process (sync_daemon.py)
+def close_stages():
+	for stage in list(_open_stages):
+		stage.close()
+
+atexit.register(close_stages)
+
+# Several stages can run in the same process (od2samba4.py sync), every stage only accounts for the time and
+# LDAP round trips between its creation and close().
+# Long-running processes (sync_daemon.py) pass write_at_exit = False and call close() after every batch instead.
+class Stage(object):
+	def __init__(self, name, config, write_at_exit = True):
+		self.name = name
+		self.counts = {}
+		self.success = False
+		self.closed = False
+		self.start_time = time.time()
+		self.start_cputime = _cputime()
+		self.start_round_trips = ldap_round_trips
+		self.metrics_dir = config.get("files", "metrics_dir") if config.has_option("files", "metrics_dir") else None
+		if write_at_exit:
+			_open_stages.add(self)
+
+	# Increase entry counter `key` (e.g. "users_fetched") by n
+	def count(self, key, n = 1):
+		self.counts[key] = self.counts.get(key, 0) + n
+
+	# Mark stage as successfully completed and write its metrics, must be called at the end of the script
+	def finish(self):
+		self.success = True
+		self.close()
+
+	# Write the metrics (if metrics_dir is configured), only the first call has an effect
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			_open_stages.discard(self)
+			if self.metrics_dir:
+				self.write()
+
+	def summary(self):
+		return {
+			"wall_seconds" : time.time() - self.start_time,
+			"cpu_seconds" : _cputime() - self.start_cputime,
+			"ldap_round_trips" : ldap_round_trips - self.start_round_trips,
+			"entries" : self.counts,
+			"success" : self.success,
+			"start_time" : self.start_time
+		}
+
+	def write(self):
+		if not os.path.isdir(self.metrics_dir):
+			os.makedirs(self.metrics_dir)
+		summary = self.summary()
+
+		label = "{stage=\"" + self.name + "\"}"
+		prom = []
+		prom.append("# HELP od2samba4_stage_wall_seconds Wall time of the last run of the stage")
+		prom.append("# TYPE od2samba4_stage_wall_seconds gauge")
+		prom.append("od2samba4_stage_wall_seconds" + label + " " + repr(summary["wall_seconds"]))
+		prom.append("# HELP od2samba4_stage_cpu_seconds CPU time (user + system, including child processes) of the last run of the stage")
+		prom.append("# TYPE od2samba4_stage_cpu_seconds gauge")
+		prom.append("od2samba4_stage_cpu_seconds" + label + " " + repr(summary["cpu_seconds"]))
+		prom.append("# HELP od2samba4_stage_ldap_round_trips LDAP round trips of the last run of the stage")
+		prom.append("# TYPE od2samba4_stage_ldap_round_trips gauge")
+		prom.append("od2samba4_stage_ldap_round_trips" + label + " " + str(summary["ldap_round_trips"]))
+		prom.append("# HELP od2samba4_stage_entries Entries processed during the last run of the stage")
+		prom.append("# TYPE od2samba4_stage_entries gauge")
+		for key in sorted(self.counts):
+			prom.append("od2samba4_stage_entries{stage=\"" + self.name + "\",type=\"" + key + "\"} " + str(self.counts[key]))
+		prom.append("# HELP od2samba4_stage_success Whether the last run of the stage completed successfully")
+		prom.append("# TYPE od2samba4_stage_success gauge")
+		prom.append("od2samba4_stage_success" + label + " " + ("1" if self.success else "0"))
+		prom.append("# HELP od2samba4_stage_last_run_timestamp_seconds Start time of the last run of the stage")
+		prom.append("# TYPE od2samba4_stage_last_run_timestamp_seconds gauge")
+		prom.append("od2samba4_stage_last_run_timestamp_seconds" + label + " " + repr(self.start_time))
+		_writeFile(os.path.join(self.metrics_dir, "od2samba4_" + self.name + ".prom"), "\n".join(prom) + "\n")
+
+		# Add this stage to the JSON summary of the current run, start a new summary for a new run
+		run_id = os.environ.get("OD2S4_RUN_ID", repr(self.start_time))
+		summary_filename = os.path.join(self.metrics_dir, "run_summary.json")
+		run_summary = {}
+		if os.path.exists(summary_filename):
+			run_summary = json.loads(open(summary_filename, "r").read())
+		if run_summary.get("run_id") != run_id:
+			run_summary = {"run_id" : run_id, "stages" : {}}
+		run_summary["stages"][self.name] = summary
+		_writeFile(summary_filename, json.dumps(run_summary, indent = 4, sort_keys = True))
@@ -0,0 +1,119 @@
+# Tracing of the external processes started by the od2samba4 scripts (heimdal, decompressors, ssh, ...).
+# Processes are started using Tracer.Popen instead of subprocess.Popen. When such a process is waited for,
+# its resource usage is appended to the trace file (`trace_file` in the [files] section of od2samba4.conf)
+# in JSON Lines format, one object per process:
+# - run_id, stage, command and start_time
+# - wall_seconds, user_seconds, sys_seconds and max_rss_kb (from wait4, i.e. including the process' own
+#   children that it waited for)
+# - exit_status (negative signal number if the process was killed by a signal)
+# - read_bytes and written_bytes: bytes passed to read / write system calls, including pipes and sockets
+#   (rchar / wchar of /proc/<pid>/io, read after the process exited but before it is reaped; like the resource
+#   usage, this includes the process' own children that it waited for). None if not available.
+# Nothing is written if trace_file isn't configured.
+#
+# Shell scripts can trace commands using `python2 -m od2s4.proctrace STAGE COMMAND [ARGS...]`, which runs the
+# command with the same stdin / stdout / stderr and exits with its exit status.
+
+from __future__ import print_function
+from ConfigParser import RawConfigParser
+import subprocess
+import ctypes
+import errno
+import json
+import time
+import sys
+import os
+
+# waitid(2) constants (Linux), WNOWAIT leaves the process in a waitable state
+P_PID = 1
+WEXITED = 4
+WNOWAIT = 0x01000000
+SIGINFO_SIZE = 128
+
+try:
+	_libc = ctypes.CDLL(None, use_errno = True)
+	_waitid = _libc.waitid
+except (OSError, AttributeError):
+	_waitid = None
+
+def _retry(function, *args):
+	while True:
+		try:
+			return function(*args)
+		except OSError as e:
+			if e.errno != errno.EINTR:
+				raise
+
+# Wait until process `pid` has exited without reaping it, returns False if that isn't possible
+def _waitExited(pid):
+	if _waitid is None:
+		return False
+	siginfo = ctypes.create_string_buffer(SIGINFO_SIZE)
+	while _waitid(P_PID, pid, siginfo, WEXITED | WNOWAIT) != 0:
+		if ctypes.get_errno() != errno.EINTR:
+			return False
+	return True
+
+# Returns (rchar, wchar) of process `pid`, (None, None) if /proc/<pid>/io can't be read
+def _readIO(pid):
+	try:
+		io = dict(line.split(": ") for line in open("/proc/" + str(pid) + "/io", "r").read().splitlines())
+		return (int(io["rchar"]), int(io["wchar"]))
+	except (IOError, ValueError, KeyError):
+		return (None, None)
+
+class Tracer(object):
+	def __init__(self, stage, config):
+		self.stage = stage
+		self.filename = config.get("files", "trace_file") if config.has_option("files", "trace_file") else None
+
+	# Replacement for subprocess.Popen(args, ...)
+	def Popen(self, args, **kwargs):
+		return TracedProcess(self, args, **kwargs)
+
+	# Append a trace record, a single write to a file opened in append mode, so that records of
+	# several processes writing to the same trace file don't interleave
+	def record(self, entry):
+		if self.filename:
+			entry["run_id"] = os.environ.get("OD2S4_RUN_ID")
+			entry["stage"] = self.stage
+			trace_file = open(self.filename, "a")
+			trace_file.write(json.dumps(entry, sort_keys = True) + "\n")
+			trace_file.close()
+
+# subprocess.Popen that reaps the process using wait4 in wait() and records its resource usage.
+# Processes must be waited for using wait(), poll() doesn't record anything.
+class TracedProcess(subprocess.Popen):
+	def __init__(self, tracer, args, **kwargs):
+		self.tracer = tracer
+		self.command = list(args) if isinstance(args, (list, tuple)) else [args]
+		self.start_time = time.time()
+		subprocess.Popen.__init__(self, args, **kwargs)
+
+	def wait(self):
+		if self.returncode is None:
+			read_bytes, written_bytes = (None, None)
+			if self.tracer.filename and _waitExited(self.pid):
+				read_bytes, written_bytes = _readIO(self.pid)
+			pid, status, rusage = _retry(os.wait4, self.pid, 0)
+			self._handle_exitstatus(status)
+			self.tracer.record({
+				"command" : self.command,
+				"start_time" : self.start_time,
+				"wall_seconds" : time.time() - self.start_time,
+				"user_seconds" : rusage.ru_utime,
+				"sys_seconds" : rusage.ru_stime,
+				"max_rss_kb" : rusage.ru_maxrss,
+				"exit_status" : self.returncode,
+				"read_bytes" : read_bytes,
+				"written_bytes" : written_bytes
+			})
+		return self.returncode
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3:
+		sys.exit("Usage: python2 -m od2s4.proctrace STAGE COMMAND [ARGS...]")
+	config = RawConfigParser()
+	config.read("od2samba4.conf")
+	status = Tracer(sys.argv[1], config).Popen(sys.argv[2:]).wait()
+	sys.exit(status if status >= 0 else 128 - status)
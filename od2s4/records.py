@@ -0,0 +1,71 @@
+# Compact representations of the directory entries processed by the conversion scripts.
+# python-ldap returns every entry as a dictionary that maps attribute names to lists of values,
+# even for attributes that only ever have a single value. The classes below use __slots__ instead:
+# every attribute is a fixed field without per-instance dictionary, single-valued attributes hold
+# a string (or None if the attribute is missing) and multi-valued attributes a tuple.
+# Entries are converted from search results with from_ldap() as soon as they are received, so that
+# the result dictionaries can be freed right away.
+
+class Record(object):
+	__slots__ = ()
+
+	# (LDAP attribute, field) pairs of single-valued and multi-valued attributes, used by from_ldap()
+	SINGLE = ()
+	MULTI = ()
+
+	def __init__(self, **fields):
+		for field in self.__slots__:
+			setattr(self, field, fields.get(field))
+
+	# Create a record from a search result attribute dictionary. Only the first value of single-valued
+	# attributes is kept.
+	@classmethod
+	def from_ldap(cls, attributes):
+		record = cls.__new__(cls)
+		for attr, field in cls.SINGLE:
+			values = attributes.get(attr)
+			setattr(record, field, values[0] if values else None)
+		for attr, field in cls.MULTI:
+			setattr(record, field, tuple(attributes.get(attr, ())))
+		return record
+
+	# Objects without __dict__ need explicit state to be pickled (e.g. when passed to worker processes)
+	def __getstate__(self):
+		return tuple(getattr(self, field) for field in self.__slots__)
+
+	def __setstate__(self, state):
+		for field, value in zip(self.__slots__, state):
+			setattr(self, field, value)
+
+# Open Directory user, see USERATTRIBUTES in convert_users.py
+class User(Record):
+	__slots__ = ("uid", "cn", "givenName", "sn", "homeurl", "homeDirectory", "loginShell", "gidNumber", "uidNumber",
+			"mail", "generateduid", "mailattribute", "modifyTimestamp")
+	SINGLE = (("uid", "uid"), ("cn", "cn"), ("givenName", "givenName"), ("sn", "sn"), ("apple-user-homeurl", "homeurl"),
+			("homeDirectory", "homeDirectory"), ("loginShell", "loginShell"), ("gidNumber", "gidNumber"),
+			("uidNumber", "uidNumber"), ("mail", "mail"), ("apple-generateduid", "generateduid"),
+			("apple-user-mailattribute", "mailattribute"), ("modifyTimestamp", "modifyTimestamp"))
+
+# Open Directory group, see GROUPATTRIBUTES in convert_groups.py
+class Group(Record):
+	__slots__ = ("cn", "gidNumber", "realname", "generateduid", "memberUid", "nestedgroups")
+	SINGLE = (("cn", "cn"), ("gidNumber", "gidNumber"), ("apple-group-realname", "realname"), ("apple-generateduid", "generateduid"))
+	MULTI = (("memberUid", "memberUid"), ("apple-group-nestedgroup", "nestedgroups"))
+
+# Hashes of a Kerberos principal, as stored in the hashes file (see od2s4/hashstore.py).
+# type1, type3, type17, type18 and type23 contain hashes in hexadecimal form (None if not found in the dump),
+# flags are the HDBFlags as integer.
+class HashRecord(Record):
+	__slots__ = ("username", "salt", "flags", "type1", "type3", "type17", "type18", "type23")
+
+	HASHTYPES = ("type1", "type3", "type17", "type18", "type23")
+
+	# Dictionary in the format of the JSON export and the hashes state file: "salt", "flags" (decimal string)
+	# and the hashes that are present, without "username"
+	def props(self):
+		props = {"salt" : self.salt, "flags" : str(self.flags)}
+		for hashtype in self.HASHTYPES:
+			value = getattr(self, hashtype)
+			if value is not None:
+				props[hashtype] = value
+		return props
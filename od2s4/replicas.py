@@ -0,0 +1,148 @@
+# Selection of the Open Directory server used for searching users and groups.
+# By default, all searches go to the OD master (`url` in the [opendirectory] section of od2samba4.conf).
+# If `replicas` (whitespace-separated LDAP URLs) are configured, searches go to a replica instead, so that
+# large searches don't compete with authentication requests on the master: Binds are sent to all replicas
+# at once and the replica that answers first (i.e. the one that currently responds fastest) is used. If several
+# replicas have answered by the time the connection is needed, one of them is picked at random.
+# Replicas that fail or don't answer within `replica_timeout` seconds are skipped for the rest of the run,
+# the master is only used if no replica is available.
+# If the server fails during a search, the search is restarted on another server and entries that were
+# already returned are skipped.
+
+from __future__ import print_function
+from od2s4.ldapsearch import search_paged
+import random
+import ldap
+import time
+
+DEFAULT_REPLICA_TIMEOUT = 5
+
+# Errors after which the search is retried on another server
+FAILOVER_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT, ldap.UNAVAILABLE, ldap.BUSY)
+
+class ReplicaPool(object):
+	def __init__(self, config):
+		self.master = config.get("opendirectory", "url")
+		self.replicas = config.get("opendirectory", "replicas").split() if config.has_option("opendirectory", "replicas") else []
+		self.timeout = config.getint("opendirectory", "replica_timeout") if config.has_option("opendirectory", "replica_timeout") else DEFAULT_REPLICA_TIMEOUT
+		self.who = "uid=" + config.get("opendirectory", "username") + ",cn=users," + config.get("opendirectory", "dc")
+		self.cred = config.get("opendirectory", "password")
+		self.pending = []
+		self.current = None
+
+	# Send a bind request, returns (url, connection, msgid, start time)
+	def _bind(self, url):
+		conn = ldap.initialize(url)
+		conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+		return (url, conn, conn.simple_bind(self.who, self.cred), time.time())
+
+	def _failed(self, url, error):
+		print("Open Directory replica " + url + " failed: " + str(error))
+		self.replicas.remove(url)
+
+	# Start connecting: Send binds to all remaining replicas (in random order, so that replicas that respond
+	# equally fast share the load) or to the master if there are none, without waiting for the results
+	def connect(self):
+		if self.current is not None or self.pending:
+			return
+		if self.replicas:
+			print("Connecting to Open Directory replicas " + ", ".join(self.replicas))
+			for url in random.sample(self.replicas, len(self.replicas)):
+				try:
+					self.pending.append(self._bind(url))
+				except ldap.LDAPError as e:
+					self._failed(url, e)
+		if not self.pending:
+			print("Connecting to Open Directory server " + self.master)
+			self.pending.append(self._bind(self.master))
+
+	# Wait for the first successful bind of a replica, returns (url, connection) or None
+	def _waitFastest(self):
+		deadline = time.time() + self.timeout
+		while self.pending and time.time() < deadline:
+			for entry in list(self.pending):
+				url, conn, msgid, start = entry
+				try:
+					if conn.result(msgid, timeout = 0) == (None, None):
+						continue
+				except ldap.TIMEOUT:
+					continue
+				except ldap.LDAPError as e:
+					self.pending.remove(entry)
+					self._failed(url, e)
+					continue
+				self.pending.remove(entry)
+				for other in self.pending:
+					other[1].unbind_s()
+				self.pending = []
+				print("Using Open Directory replica " + url + " (responded within " + str(int((time.time() - start) * 1000)) + " ms)")
+				return (url, conn)
+			time.sleep(0.01)
+		for url, conn, msgid, start in self.pending:
+			conn.unbind_s()
+			self._failed(url, "no response within " + str(self.timeout) + " seconds")
+		self.pending = []
+		return None
+
+	# Bound connection to the selected server
+	def conn(self):
+		if self.current is None:
+			self.connect()
+			if self.pending[0][0] != self.master:
+				self.current = self._waitFastest()
+			if self.current is None:
+				if not self.pending:
+					print("No Open Directory replica available, using " + self.master)
+					self.pending.append(self._bind(self.master))
+				url, conn, msgid, start = self.pending.pop()
+				conn.result(msgid)
+				self.current = (url, conn)
+		return self.current[1]
+
+	# The server of connection `conn` failed with `error`. Returns True if another server can be tried.
+	def failover(self, conn, error):
+		if self.current is None or self.current[1] is not conn:
+			# Another search already switched to a different server
+			return True
+		if self.current[0] == self.master:
+			return False
+		self._failed(self.current[0], error)
+		self.current = None
+		return True
+
+	# Paged search (see od2s4/ldapsearch.py) with failover
+	def search(self, base, scope, filterstr, attrlist, page_size):
+		return FailoverSearch(self, base, scope, filterstr, attrlist, page_size)
+
+class FailoverSearch(object):
+	def __init__(self, pool, base, scope, filterstr, attrlist, page_size):
+		self.pool = pool
+		self.args = (base, scope, filterstr, attrlist, page_size)
+		self.search = self._start()
+
+	def _start(self):
+		while True:
+			self.conn = self.pool.conn()
+			try:
+				return search_paged(self.conn, *self.args)
+			except FAILOVER_ERRORS as e:
+				if not self.pool.failover(self.conn, e):
+					raise
+
+	# DNs are only remembered while a replica is used, otherwise there is nothing to fail over to
+	def __iter__(self):
+		seen = set() if self.pool.replicas else None
+		while True:
+			try:
+				for dn, attributes in self.search:
+					if seen is not None:
+						if dn in seen:
+							continue
+						seen.add(dn)
+					yield (dn, attributes)
+				return
+			except FAILOVER_ERRORS as e:
+				if not self.pool.failover(self.conn, e):
+					raise
+				print("Restarting search of " + self.args[0] + " on another server")
+				self.search = self._start()
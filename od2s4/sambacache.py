@@ -0,0 +1,128 @@
+# Local snapshot of the Samba4 users and groups (in cn=Users) that the od2samba4 scripts need:
+# uid -> DN of users, cn, objectSid, gidNumber and members of groups.
+# The snapshot is kept in an SQLite database (`samba_cache` in the `[files]` section of od2samba4.conf)
+# along with the highest committed USN of the domain controller at the time of the last refresh.
+# A refresh only fetches users and groups whose uSNChanged is higher than that, as well as the objectGUIDs
+# of objects that were deleted (using the show deleted control) or moved out of cn=Users since then.
+# If the USN didn't change, a refresh takes a single round trip (reading the rootDSE).
+#
+# USNs are local to a domain controller, so the snapshot is rebuilt by a full search if the cache was
+# created for another DC (dsServiceName) or base DN. Delete the cache file to force a full search.
+# If `samba_cache` isn't configured, the snapshot is kept in memory and a full search is done every time.
+
+from ldap.controls import LDAPControl
+from od2s4.ldapsearch import search_paged, DEFAULT_PAGE_SIZE
+from od2s4 import metrics
+import binascii
+import sqlite3
+import base64
+import json
+import ldap
+
+# LDAP_SERVER_SHOW_DELETED_OID: Also return deleted objects (tombstones)
+SHOW_DELETED_OID = "1.2.840.113556.1.4.417"
+
+# Attributes that are kept in the snapshot, binary attributes are stored base64-encoded
+USER_ATTRIBUTES = ["uid"]
+GROUP_ATTRIBUTES = ["cn", "objectSid", "gidNumber", "member"]
+BINARY_ATTRIBUTES = ["objectSid"]
+
+class SambaSnapshot(object):
+	def __init__(self, conn, samba4_dc, filename = ":memory:", page_size = DEFAULT_PAGE_SIZE):
+		self.conn = conn
+		self.samba4_dc = samba4_dc
+		self.base = "cn=Users," + samba4_dc
+		self.page_size = page_size
+		self.db = sqlite3.connect(filename)
+		self.db.text_factory = str
+		self.db.execute("CREATE TABLE IF NOT EXISTS objects (guid TEXT PRIMARY KEY, dn TEXT, kind TEXT, attributes TEXT)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+	def _meta(self, key):
+		row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+		return row[0] if row else None
+
+	def _setMeta(self, key, value):
+		self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+	# Store a user or group search result in the snapshot (or remove it if it is no longer in cn=Users)
+	def _store(self, dn, attributes):
+		guid = binascii.hexlify(attributes["objectGUID"][0])
+		if not dn.lower().endswith("," + self.base.lower()):
+			self.db.execute("DELETE FROM objects WHERE guid = ?", (guid,))
+			return
+
+		kind = "group" if "group" in [c.lower() for c in attributes.get("objectClass", [])] else "user"
+		cached = {}
+		for attr in (GROUP_ATTRIBUTES if kind == "group" else USER_ATTRIBUTES):
+			if attr in attributes:
+				cached[attr] = [base64.b64encode(v) for v in attributes[attr]] if attr in BINARY_ATTRIBUTES else attributes[attr]
+		self.db.execute("INSERT OR REPLACE INTO objects (guid, dn, kind, attributes) VALUES (?, ?, ?, ?)",
+				(guid, dn, kind, json.dumps(cached)))
+
+	# Bring the snapshot up to date, returns the number of users and groups that were fetched
+	def refresh(self):
+		metrics.ldap_round_trips += 1
+		rootdse = self.conn.search_s("", ldap.SCOPE_BASE, "(objectClass=*)", ["dsServiceName", "highestCommittedUSN"])
+		rootdse = rootdse[0][1] if rootdse else {}
+		server = rootdse.get("dsServiceName", [None])[0]
+		usn = int(rootdse["highestCommittedUSN"][0]) if "highestCommittedUSN" in rootdse else None
+
+		cached_usn = self._meta("usn")
+		attrlist = ["objectGUID", "objectClass"] + USER_ATTRIBUTES + GROUP_ATTRIBUTES
+		count = 0
+		if server is not None and server == self._meta("server") and self.samba4_dc == self._meta("dc") and cached_usn is not None:
+			if usn == int(cached_usn):
+				return 0
+
+			# Changed objects anywhere in the domain (to notice objects moved out of cn=Users) and deleted objects
+			changed = search_paged(self.conn, self.samba4_dc, ldap.SCOPE_SUBTREE, "(&(|(objectclass=person)(objectclass=group))"
+					+ "(uSNChanged>=" + str(int(cached_usn) + 1) + "))", attrlist, self.page_size)
+			deleted = search_paged(self.conn, self.samba4_dc, ldap.SCOPE_SUBTREE, "(&(isDeleted=TRUE)(uSNChanged>="
+					+ str(int(cached_usn) + 1) + "))", ["objectGUID"], self.page_size, [LDAPControl(SHOW_DELETED_OID, True)])
+			for dn, attributes in changed:
+				self._store(dn, attributes)
+				count += 1
+			for dn, attributes in deleted:
+				self.db.execute("DELETE FROM objects WHERE guid = ?", (binascii.hexlify(attributes["objectGUID"][0]),))
+		else:
+			self.db.execute("DELETE FROM objects")
+			for dn, attributes in search_paged(self.conn, self.base, ldap.SCOPE_SUBTREE, "(|(objectclass=person)(objectclass=group))",
+					attrlist, self.page_size):
+				self._store(dn, attributes)
+				count += 1
+
+		# highestCommittedUSN was read before searching, so changes made during the search are fetched again next time
+		self._setMeta("server", server)
+		self._setMeta("dc", self.samba4_dc)
+		self._setMeta("usn", str(usn) if usn is not None else None)
+		self.db.commit()
+		return count
+
+	def _objects(self, kind):
+		for dn, attributes in self.db.execute("SELECT dn, attributes FROM objects WHERE kind = ? ORDER BY dn", (kind,)):
+			attributes = json.loads(attributes)
+			entry = {}
+			for attr, values in attributes.iteritems():
+				attr = str(attr)
+				entry[attr] = [base64.b64decode(v) for v in values] if attr in BINARY_ATTRIBUTES else [v.encode("utf-8") for v in values]
+			yield (dn, entry)
+
+	# Yield (dn, attributes) tuples of users, like a search for (objectclass=person) with USER_ATTRIBUTES
+	def users(self):
+		return self._objects("user")
+
+	# Yield (dn, attributes) tuples of groups, like a search for (objectclass=group) with GROUP_ATTRIBUTES
+	def groups(self):
+		return self._objects("group")
+
+	def close(self):
+		self.db.close()
+
+# Open and refresh the Samba4 snapshot configured in `config`
+def open_snapshot(conn, config, page_size = DEFAULT_PAGE_SIZE):
+	filename = config.get("files", "samba_cache") if config.has_option("files", "samba_cache") else ":memory:"
+	snapshot = SambaSnapshot(conn, config.get("samba4", "dc"), filename, page_size)
+	count = snapshot.refresh()
+	print("Samba4 snapshot refreshed, " + str(count) + " changed users and groups fetched")
+	return snapshot
@@ -0,0 +1,83 @@
+#!/usr/bin/env python2
+
+# Single entry point for all od2samba4 stages: `./od2samba4.py COMMAND [OPTIONS]` runs a stage in the current
+# interpreter, with the same options as the corresponding script (e.g. `./od2samba4.py convert-users --incremental`
+# is equivalent to `./convert_users.py --incremental`).
+# All stages run by the same process share od2samba4.conf and the bound connections to Open Directory and
+# Samba4 (see od2s4/context.py). Stage modules are only imported when they are run, so that e.g. the samba
+# bindings are only loaded by the stages that need them.
+#
+# `./od2samba4.py sync` runs a complete synchronization (this is what sync/sync.sh does) in a single process:
+# The KDC dump is streamed via SSH into the hash extraction, then hashes, users and groups are converted,
+# all LDIFs are imported and the state of the import is recorded.
+
+from __future__ import print_function
+from optparse import OptionParser
+from od2s4 import metrics
+from od2s4.context import Context
+from od2s4.proctrace import Tracer
+import importlib
+import time
+import sys
+import os
+
+# Subcommand, module (script) that implements it, description
+COMMANDS = [
+	("extract-hashes", "extract_hashes", "Extract password hashes from the MIT Kerberos dump"),
+	("convert-hashes", "convert_hashes", "Convert password hashes to LDIF"),
+	("convert-users", "convert_users", "Convert Open Directory users to LDIF"),
+	("convert-groups", "convert_groups", "Convert Open Directory groups and memberships to LDIF"),
+	("import", "import_samba4", "Import LDIFs into sam.ldb"),
+	("sync", None, "Run a complete synchronization (like sync/sync.sh)")
+]
+
+def loadStage(module):
+	return importlib.import_module(module)
+
+def sync(args, context):
+	parser = OptionParser(usage = "%prog sync")
+	parser.parse_args(args)
+	config = context.config
+
+	# All stages of this run share the same run ID in the metrics run summary
+	os.environ.setdefault("OD2S4_RUN_ID", repr(time.time()))
+
+	# Stream the KDC dump directly into the hash extraction, the dump is never written to disk
+	extract_hashes = loadStage("extract_hashes")
+	ssh = extract_hashes.sshDump(config, Tracer("sync", config))
+	try:
+		extract_hashes.main(["--dump", "-"], context, dump_file = ssh.stdout)
+	finally:
+		ssh.stdout.close()
+		status = ssh.wait()
+	if status != 0:
+		sys.exit("ssh failed with exit status " + str(status))
+
+	# Process hashes, generate LDIFs for import
+	# This will not add newly generated groups, but it will establish group membership for new users
+	loadStage("convert_hashes").main([], context)
+	loadStage("convert_users").main(["--incremental"], context)
+	loadStage("convert_groups").main([], context)
+
+	# LDIF import: new users, changed users, hashes and secondary group memberships, then record the state of
+	# the import, so that these changes will be skipped next time (except for quarantined records)
+	print("Importing LDIFs into Samba4 AD DC")
+	loadStage("import_samba4").main(["--commit-state"], context)
+
+if __name__ == "__main__":
+	parser = OptionParser(usage = "%prog [--profile FILE] COMMAND [OPTIONS]\n\nCommands:\n"
+			+ "\n".join("  " + command.ljust(16) + description for command, module, description in COMMANDS)
+			+ "\n\nUse %prog COMMAND --help to list the options of a command.")
+	parser.disable_interspersed_args()
+	parser.add_option("--profile", default = None, metavar = "FILE", help = "Run under cProfile and write the stats to FILE")
+	(cmdline_opts, args) = parser.parse_args()
+	commands = dict((command, module) for command, module, description in COMMANDS)
+	if not args or not args[0] in commands:
+		parser.error("Missing or unknown command")
+	metrics.start_profile(cmdline_opts.profile)
+
+	context = Context()
+	if args[0] == "sync":
+		sync(args[1:], context)
+	else:
+		loadStage(commands[args[0]]).main(args[1:], context)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python2
+
+# Synchronization daemon, an event-driven alternative to running sync/sync.sh from the systemd timer.
+# The daemon keeps a bound connection to Open Directory and listens for changes of users and groups
+# using syncrepl (RFC 4533, refreshAndPersist mode), which requires the syncprov overlay on the OD server.
+# sam.ldb is opened once at startup and kept open, LDIFs are imported using the functions of import_samba4.py.
+#
+# Changes are debounced: A batch is started once no change was seen for `debounce` seconds, but at the
+# latest `max_delay` seconds after the first change of the batch. Only the steps affected by the changes are run:
+# - Group changes: convert_groups.py, import group memberships
+# - User changes: convert_users.py --incremental, import new and changed users, then extract and convert hashes
+#   (new users have to be in Samba4 before their hashes can be converted) and import them, then group memberships
+#   (new users are added to their secondary groups)
+# Password changes don't modify the OD user entry, so hashes are synchronized by the periodic full reconcile,
+# which runs all steps every `reconcile_interval` seconds and at startup. The reconcile only converts hashes that
+# changed since the last import (see the hashes state in convert_hashes.py), so that unchanged passwords aren't
+# rewritten every time.
+#
+# The stages run in the daemon process (like with `od2samba4.py sync`) and share one Context (see od2s4/context.py):
+# od2samba4.conf is read once, the bound connections to Open Directory and Samba4 and the snapshot of Samba4 users
+# and groups are kept between batches. They are established again after a failed batch. The current working
+# directory has to contain od2samba4.conf and groups.json.
+
+from __future__ import print_function
+from optparse import OptionParser
+from ldap.ldapobject import LDAPObject
+from ldap.syncrepl import SyncreplConsumer
+from import_samba4 import IMPORTS, ImportFailed, openSamDB, importLdif, getCommitSize, commitUsersState, commitHashesState, pendingState
+from od2s4 import metrics
+from od2s4.context import Context
+from od2s4.proctrace import Tracer
+import extract_hashes
+import convert_hashes
+import convert_users
+import convert_groups
+import traceback
+import ldap
+import time
+import sys
+import os
+
+# Parse command line options
+parser = OptionParser()
+parser.add_option("-1", "--once", action="store_true", default = False, help = "Run a single full reconcile and exit")
+(cmdline_opts, args) = parser.parse_args()
+
+# Configuration and connections, shared by all stages
+context = Context()
+config = context.config
+
+def getDaemonOption(key, default):
+	return config.getint("daemon", key) if config.has_option("daemon", key) else default
+
+od_username = config.get("opendirectory", "username")
+od_password = config.get("opendirectory", "password")
+od_url = config.get("opendirectory", "url")
+od_dc = config.get("opendirectory", "dc")
+sam_ldb = config.get("samba4", "sam_ldb")
+commit_size = getCommitSize(config)
+debounce = getDaemonOption("debounce", 30)
+max_delay = getDaemonOption("max_delay", 300)
+reconcile_interval = getDaemonOption("reconcile_interval", 3600)
+users_state = config.get("files", "users_state")
+
+# Record resource usage of child processes (ssh, heimdal; only written if trace_file is configured)
+tracer = Tracer("sync_daemon", config)
+
+# Time to wait before retrying a failed batch or reconnecting to Open Directory
+RETRY_DELAY = 60
+
+class StepFailed(Exception):
+	pass
+
+# Run the main() function of stage `module` with the shared context. Stages exit using sys.exit() on errors,
+# these and unexpected exceptions (e.g. lost connections) fail the batch instead of the daemon.
+def runStep(module, args = [], **kwargs):
+	print("Running " + " ".join([module.__name__] + args))
+	try:
+		module.main(args, context, **kwargs)
+	except SystemExit as e:
+		if e.code:
+			metrics.close_stages()
+			raise StepFailed(module.__name__ + " failed: " + str(e.code))
+	except Exception as e:
+		traceback.print_exc()
+		metrics.close_stages()
+		raise StepFailed(module.__name__ + " failed: " + str(e))
+
+# Stream the KDC dump from the OD server into the hash extraction (like od2samba4.py sync)
+def extractHashes():
+	ssh = extract_hashes.sshDump(config, tracer)
+	try:
+		runStep(extract_hashes, ["--dump", "-"], dump_file = ssh.stdout)
+	finally:
+		ssh.stdout.close()
+		status = ssh.wait()
+	if status != 0:
+		raise StepFailed("ssh failed with exit status " + str(status))
+
+# Returns the DNs of quarantined records
+def importFiles(samdb, stage, options):
+	quarantined = []
+	for option, configkey, controls, description in IMPORTS:
+		if option in options:
+			filename = config.get("files", configkey)
+			print("Importing " + description + " from " + filename)
+			count, dns = importLdif(samdb, filename, controls, commit_size, context.journal())
+			stage.count("records_imported", count)
+			stage.count(option + "_records_imported", count)
+			stage.count("records_quarantined", len(dns))
+			print("Imported " + str(count) + " records")
+			if dns:
+				print("Warning: " + str(len(dns)) + " records could not be imported and were quarantined in " + filename + ".quarantine")
+			quarantined += dns
+	return quarantined
+
+# Run the conversion and import steps for `kinds` (subset of "users", "hashes", "groups")
+# Returns True if all steps succeeded.
+def runBatch(samdb, kinds, reconcile = False):
+	global context
+	print("Synchronizing " + ", ".join(k for k in ["users", "hashes", "groups"] if k in kinds) + (" (full reconcile)" if reconcile else ""))
+	os.environ["OD2S4_RUN_ID"] = repr(time.time())
+	stage = metrics.Stage("sync_daemon", config, write_at_exit = False)
+	try:
+		if "users" in kinds:
+			runStep(convert_users, ["--incremental"])
+			commitUsersState(users_state, importFiles(samdb, stage, ["new_users", "changed_users"]))
+		if "hashes" in kinds:
+			extractHashes()
+			runStep(convert_hashes)
+			quarantined = importFiles(samdb, stage, ["hashes"])
+			hashes_state = pendingState(config, "hashes_state")
+			if hashes_state:
+				commitHashesState(samdb, hashes_state, quarantined)
+		if "groups" in kinds:
+			runStep(convert_groups)
+			importFiles(samdb, stage, ["memberships"])
+		stage.finish()
+		print("Synchronization finished")
+	except (StepFailed, ImportFailed) as e:
+		print("Synchronization failed: " + str(e))
+
+		# The connections may have been lost, establish them again in the next batch
+		context = Context()
+	finally:
+		stage.close()
+	return stage.success
+
+# syncrepl consumer that collects the kinds of changed entries ("users", "groups") in `changes`.
+# The cookie is kept across reconnections, so that the refresh phase after a reconnection only
+# returns the entries that changed while the daemon was disconnected. Without cookie (at startup),
+# the refresh phase returns all entries, which are ignored (the initial reconcile covers them).
+class ODWatcher(LDAPObject, SyncreplConsumer):
+	def __init__(self, uri, cookie = None):
+		LDAPObject.__init__(self, uri)
+		self.cookie = cookie
+		self.refreshing = cookie is None
+		self.changes = set()
+
+	def syncrepl_get_cookie(self):
+		return self.cookie
+
+	def syncrepl_set_cookie(self, cookie):
+		self.cookie = cookie
+
+	def syncrepl_entry(self, dn, attributes, uuid):
+		if not self.refreshing:
+			self.changes.add("groups" if dn.lower().endswith(",cn=groups," + od_dc.lower()) else "users")
+
+	# Users and groups deleted in OD are not deleted in Samba4
+	def syncrepl_delete(self, uuids):
+		pass
+
+	def syncrepl_present(self, uuids, refreshDeletes = False):
+		pass
+
+	def syncrepl_refreshdone(self):
+		self.refreshing = False
+
+def connect(cookie):
+	print("Connecting to Open Directory server")
+	watcher = ODWatcher(od_url, cookie)
+	watcher.simple_bind_s("uid=" + od_username + ",cn=users," + od_dc, od_password)
+	msgid = watcher.syncrepl_search(od_dc, ldap.SCOPE_SUBTREE, mode = "refreshAndPersist",
+			filterstr = "(|(objectclass=person)(objectclass=posixGroup))", attrlist = ["1.1"])
+	return (watcher, msgid)
+
+# Use certificates only for encryption, not authentication (self-signed)
+ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_ALLOW)
+
+print("Opening " + sam_ldb)
+samdb = openSamDB(sam_ldb)
+
+if cmdline_opts.once:
+	sys.exit(0 if runBatch(samdb, ["users", "hashes", "groups"], reconcile = True) else 1)
+
+watcher = None
+cookie = None
+pending = set()
+first_change = None
+last_change = None
+not_before = 0
+next_reconcile = time.time()
+
+while True:
+	# Connect before the initial reconcile, so that changes made during the reconcile are received
+	if watcher is None:
+		try:
+			watcher, msgid = connect(cookie)
+		except ldap.LDAPError as e:
+			print("Connecting to Open Directory failed: " + str(e) + ", retrying in " + str(RETRY_DELAY) + " seconds")
+			time.sleep(RETRY_DELAY)
+			continue
+
+	now = time.time()
+	if now >= next_reconcile:
+		pending.clear()
+		success = runBatch(samdb, ["users", "hashes", "groups"], reconcile = True)
+		next_reconcile = time.time() + (reconcile_interval if success else RETRY_DELAY)
+		continue
+
+	if pending and now >= max(not_before, min(last_change + debounce, first_change + max_delay)):
+		if runBatch(samdb, pending):
+			pending.clear()
+		else:
+			not_before = time.time() + RETRY_DELAY
+		continue
+
+	# Wait for changes until the next batch or reconcile is due
+	deadline = next_reconcile
+	if pending:
+		deadline = min(deadline, max(not_before, min(last_change + debounce, first_change + max_delay)))
+	try:
+		if not watcher.syncrepl_poll(msgid = msgid, timeout = max(1, deadline - now)):
+			print("Open Directory ended the syncrepl search, reconnecting")
+			watcher = None
+	except ldap.TIMEOUT:
+		pass
+	except ldap.LDAPError as e:
+		print("Connection to Open Directory lost: " + str(e))
+		watcher = None
+
+	if watcher is None:
+		time.sleep(RETRY_DELAY)
+	else:
+		cookie = watcher.cookie
+		if watcher.changes:
+			print("Changes of " + ", ".join(sorted(watcher.changes)) + " received")
+			if not pending:
+				first_change = time.time()
+			last_change = time.time()
+			# New users need their password hashes and group memberships, too
+			pending |= (set(["users", "hashes", "groups"]) if "users" in watcher.changes else watcher.changes)
+			watcher.changes.clear()